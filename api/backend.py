@@ -0,0 +1,142 @@
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import List, Dict, Any, Optional, Set, Tuple
+import numpy as np
+from config import Config
+from models import User, ChatThread, Message, SearchFilter, CorpusChunk
+
+_last_sequence = 0
+
+def next_sequence() -> int:
+    """
+    Strictly increasing per-process sequence number based on wall-clock
+    microseconds. Qdrant range filters compare as float64, so the value must
+    stay below 2**53 to page on it exactly; nanoseconds would not.
+    """
+    global _last_sequence
+    _last_sequence = max(time.time_ns() // 1000, _last_sequence + 1)
+    return _last_sequence
+
+def running_mean(centroid: Optional[List[float]], count: int, vectors: List[List[float]]) -> Tuple[List[float], int]:
+    """
+    Fold new vectors into a centroid that is the mean of `count` earlier ones,
+    without revisiting them: mean' = mean + (sum(new) - n * mean) / (count + n).
+    Vectors are unit-normalized first, matching what cosine collections store.
+    """
+    batch = np.asarray(vectors, dtype=np.float64)
+    norms = np.linalg.norm(batch, axis=1, keepdims=True)
+    batch = batch / np.where(norms > 0, norms, 1.0)
+    total = count + len(batch)
+    if centroid is None or count <= 0:
+        return batch.mean(axis=0).tolist(), len(batch)
+    mean = np.asarray(centroid, dtype=np.float64)
+    mean += (batch.sum(axis=0) - len(batch) * mean) / total
+    return mean.tolist(), total
+
+class StorageBackend(ABC):
+    """
+    Storage operations used by the websocket handlers and the Chorus loop.
+    DatabaseClient implements them on Qdrant and LocalVectorStore in-process.
+    """
+
+    def generate_unique_id(self) -> str:
+        return str(uuid.uuid4())
+
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    async def search(self, query_embedding: List[float], with_vectors: bool = False, filters: Optional[SearchFilter] = None) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def search_threads(self, query_embedding: List[float], limit: int, user_id: Optional[str] = None, exclude: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Threads whose centroid is nearest to the query, best first, as {"id", "similarity"}."""
+        ...
+
+    async def get_related_threads(self, thread_id: str, limit: int) -> List[Dict[str, Any]]:
+        """The owner's other threads nearest to this thread's centroid, best first."""
+        thread, centroid = await self.get_thread_centroid(thread_id)
+        if thread is None or centroid is None:
+            return []
+        hits = await self.search_threads(centroid, limit, user_id=thread.user_id, exclude=[thread_id])
+        threads = {related.id: related for related in await self.get_chat_threads(thread.user_id)}
+        return [
+            {**threads[hit["id"]].dict(exclude={"vector", "messages"}), "similarity": hit["similarity"]}
+            for hit in hits if hit["id"] in threads
+        ]
+
+    @abstractmethod
+    async def get_thread_centroid(self, thread_id: str) -> Tuple[Optional[ChatThread], Optional[List[float]]]:
+        ...
+
+    @abstractmethod
+    async def upsert(self, content: str, embedding: List[float], is_human_generated: bool) -> None:
+        ...
+
+    @abstractmethod
+    async def bulk_upsert(self, chunks: List[CorpusChunk]) -> None:
+        """Store embedded corpus chunks in one request; existing ids are overwritten."""
+        ...
+
+    @abstractmethod
+    async def existing_ids(self, ids: List[str]) -> Set[str]:
+        """The subset of `ids` already stored in the messages collection."""
+        ...
+
+    @abstractmethod
+    async def create_user(self, public_key: str) -> User:
+        ...
+
+    @abstractmethod
+    async def get_user(self, public_key: str) -> Optional[User]:
+        ...
+
+    @abstractmethod
+    async def get_chat_threads(self, user_id: str) -> List[ChatThread]:
+        ...
+
+    @abstractmethod
+    async def create_chat_thread(self, user_id: str, name: str) -> ChatThread:
+        ...
+
+    @abstractmethod
+    async def get_chat_thread(self, thread_id: str) -> Optional[ChatThread]:
+        ...
+
+    @abstractmethod
+    async def update_thread_summary(self, thread_id: str, summary: str, summary_seq: int):
+        """Store the summary only if `summary_seq` is past the stored one, so a slow update never rolls it back."""
+        ...
+
+    async def save_message(self, message: Message):
+        await self.save_messages([message])
+
+    @abstractmethod
+    async def save_messages(self, messages: List[Message]):
+        ...
+
+    @abstractmethod
+    async def get_messages_for_thread(self, thread_id: str, before: Optional[int] = None, limit: Optional[int] = None, before_id: Optional[str] = None) -> List[Message]:
+        """
+        Messages of a thread ordered by (seq, id). seq comes from each worker's
+        own clock, so two workers can write equal seqs to one thread; the id
+        breaks the tie. (before, before_id) is an exclusive cursor; without
+        before_id every message at seq `before` is excluded.
+        """
+        ...
+
+    @abstractmethod
+    async def get_thread_head(self, thread_id: str) -> Optional[Tuple[int, str]]:
+        """The (seq, id) of the thread's newest stored message, or None if it has none."""
+        ...
+
+def create_backend(config: Config) -> StorageBackend:
+    if config.STORAGE_BACKEND == "qdrant":
+        from database import DatabaseClient
+        return DatabaseClient(config)
+    if config.STORAGE_BACKEND == "local":
+        from local_store import LocalVectorStore
+        return LocalVectorStore(config)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {config.STORAGE_BACKEND}")
@@ -0,0 +1,146 @@
+"""
+Recall@k vs. memory vs. latency of the message-vector storage modes.
+
+Samples vectors from the live messages collection, loads them into temporary
+collections (one per quantization mode), and compares each mode's top-k
+against exact float32 search on held-out query vectors:
+
+    cd api && python -m bench.quantization --sample 20000 --queries 200 --k 10
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from typing import Dict, List, Tuple
+import numpy as np
+from qdrant_client import models
+from config import Config
+from database import DatabaseClient
+from schema import messages_quantization
+from utils import logger
+
+MODES = ["none", "scalar", "binary"]
+
+async def load_sample(db_client: DatabaseClient, size: int) -> np.ndarray:
+    vectors = []
+    offset = None
+    while len(vectors) < size:
+        points, offset = await db_client.client.scroll(
+            collection_name=db_client.config.MESSAGES_COLLECTION,
+            limit=min(1000, size - len(vectors)),
+            offset=offset,
+            with_payload=False,
+            with_vectors=True
+        )
+        vectors.extend(point.vector for point in points if point.vector)
+        if offset is None:
+            break
+    return np.asarray(vectors, dtype=np.float32)
+
+def estimated_memory(count: int, dimension: int, mode: str, on_disk: bool) -> Tuple[int, int]:
+    """(RAM bytes, disk bytes) for the vectors alone, excluding the HNSW graph."""
+    originals = count * dimension * 4
+    quantized = {"none": 0, "scalar": count * dimension, "binary": count * dimension // 8}[mode]
+    if mode == "none" or not on_disk:
+        return originals + quantized, 0
+    return quantized, originals
+
+async def build_collection(db_client: DatabaseClient, name: str, vectors: np.ndarray, mode: str, on_disk: bool):
+    client = db_client.client
+    mode_config = db_client.config.model_copy(update={"MESSAGES_QUANTIZATION": mode})
+    await client.create_collection(
+        collection_name=name,
+        vectors_config=models.VectorParams(size=vectors.shape[1], distance=models.Distance.COSINE, on_disk=on_disk),
+        quantization_config=messages_quantization(mode_config)
+    )
+    for start in range(0, len(vectors), 512):
+        batch = vectors[start:start + 512]
+        await client.upsert(
+            collection_name=name,
+            points=[
+                models.PointStruct(id=start + index, vector=vector.tolist())
+                for index, vector in enumerate(batch)
+            ]
+        )
+    # Wait for indexing and quantization to finish before timing queries
+    while (await client.get_collection(name)).status != models.CollectionStatus.GREEN:
+        await asyncio.sleep(0.5)
+
+async def run_queries(db_client: DatabaseClient, name: str, queries: np.ndarray, k: int, params: models.SearchParams) -> Tuple[List[List[int]], List[float]]:
+    hits, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        response = await db_client.client.query_points(
+            collection_name=name,
+            query=query.tolist(),
+            limit=k,
+            search_params=params,
+            with_payload=False
+        )
+        latencies.append(time.perf_counter() - start)
+        hits.append([point.id for point in response.points])
+    return hits, latencies
+
+async def benchmark(db_client: DatabaseClient, sample: int, queries_count: int, k: int, on_disk: bool, oversampling: float) -> Dict:
+    vectors = await load_sample(db_client, sample + queries_count)
+    if len(vectors) <= queries_count:
+        raise SystemExit(f"Need more than {queries_count} vectors, found {len(vectors)}")
+    rng = np.random.default_rng(0)
+    rng.shuffle(vectors)
+    queries, corpus = vectors[:queries_count], vectors[queries_count:]
+    logger.info(f"Benchmarking {len(corpus)} vectors with {len(queries)} queries, k={k}")
+
+    prefix = f"bench_quantization_{uuid.uuid4().hex[:8]}"
+    names = {mode: f"{prefix}_{mode}" for mode in MODES}
+    report = {"corpus": len(corpus), "queries": len(queries), "k": k, "on_disk": on_disk, "oversampling": oversampling, "modes": {}}
+    try:
+        for mode in MODES:
+            await build_collection(db_client, names[mode], corpus, mode, on_disk)
+
+        truth, _ = await run_queries(db_client, names["none"], queries, k, models.SearchParams(exact=True))
+        for mode in MODES:
+            params = models.SearchParams(
+                quantization=models.QuantizationSearchParams(rescore=True, oversampling=oversampling)
+            ) if mode != "none" else None
+            hits, latencies = await run_queries(db_client, names[mode], queries, k, params)
+            recall = float(np.mean([len(set(found) & set(expected)) / k for found, expected in zip(hits, truth)]))
+            ram, disk = estimated_memory(len(corpus), corpus.shape[1], mode, on_disk)
+            report["modes"][mode] = {
+                "recall_at_k": round(recall, 4),
+                "latency_p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+                "latency_p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 3),
+                "vector_ram_bytes": ram,
+                "vector_disk_bytes": disk,
+            }
+    finally:
+        for name in names.values():
+            await db_client.client.delete_collection(name)
+    return report
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sample", type=int, default=20000, help="vectors to index")
+    parser.add_argument("--queries", type=int, default=200, help="held-out query vectors")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--on-disk", action="store_true", help="keep float32 originals on disk")
+    parser.add_argument("--oversampling", type=float, default=2.0)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    db_client = DatabaseClient(Config())
+    try:
+        report = await benchmark(db_client, args.sample, args.queries, args.k, args.on_disk, args.oversampling)
+    finally:
+        await db_client.close()
+
+    print(f"{'mode':<8} {'recall@k':>9} {'p50 ms':>8} {'p95 ms':>8} {'RAM MiB':>9} {'disk MiB':>9}")
+    for mode, row in report["modes"].items():
+        print(f"{mode:<8} {row['recall_at_k']:>9.4f} {row['latency_p50_ms']:>8.2f} {row['latency_p95_ms']:>8.2f} "
+              f"{row['vector_ram_bytes'] / 2**20:>9.1f} {row['vector_disk_bytes'] / 2**20:>9.1f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    asyncio.run(main())
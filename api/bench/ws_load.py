@@ -0,0 +1,319 @@
+"""
+Throughput and tail latency of the /ws endpoint and the Chorus loop.
+
+Serves the real FastAPI app with uvicorn on a background thread, backed by the
+in-process vector store and by stand-ins for the completion and embedding APIs
+with configurable latency and token rate. N concurrent websocket clients then
+go through public_key init, create_thread and get_thread_messages, followed by
+full prompt turns. The report covers p50/p95/p99 per message type and per
+Chorus step, turns per second and the server's event-loop lag:
+
+    cd api && python -m bench.ws_load --clients 20 --turns 3 --output ws_load.json
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+import uuid
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+import numpy as np
+
+UPDATE_MARKER = 'return "RETURN"'
+
+class FakeLLM:
+    """
+    Stand-ins for litellm's acompletion and aembedding. Completions wait `ttft`
+    seconds, then stream `completion_tokens` tokens at `tokens_per_second`. The
+    Update step always answers RETURN. Embeddings are deterministic per text.
+    """
+
+    def __init__(self, ttft: float, tokens_per_second: float, completion_tokens: int, embedding_latency: float, dimension: int):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.embedding_latency = embedding_latency
+        self.dimension = dimension
+        self.completions = 0
+        self.embeddings = 0
+
+    def _reply(self, messages: List[Dict[str, str]]) -> List[str]:
+        if any(UPDATE_MARKER in message.get("content", "") for message in messages[-2:]):
+            return ["RETURN"]
+        seed = hashlib.sha1(json.dumps(messages, sort_keys=True).encode("utf-8")).hexdigest()
+        return [f"{seed[index % 40:index % 40 + 4]} " for index in range(self.completion_tokens)]
+
+    async def acompletion(self, model: str, messages: List[Dict[str, str]], stream: bool = False, **kwargs):
+        self.completions += 1
+        tokens = self._reply(messages)
+        if not stream:
+            await asyncio.sleep(self.ttft + len(tokens) / self.tokens_per_second)
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="".join(tokens)))])
+        return self._stream(tokens)
+
+    async def _stream(self, tokens: List[str]):
+        await asyncio.sleep(self.ttft)
+        for token in tokens:
+            await asyncio.sleep(1 / self.tokens_per_second)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))])
+
+    async def aembedding(self, model: str, input: List[str], **kwargs):
+        self.embeddings += 1
+        await asyncio.sleep(self.embedding_latency)
+        data = []
+        for index, text in enumerate(input):
+            seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:4], "little")
+            vector = np.random.default_rng(seed).standard_normal(self.dimension).astype(np.float32)
+            data.append({"index": index, "embedding": vector.tolist()})
+        return {"data": data}
+
+def add_storage_latency(db_client, latency: float):
+    """Make every storage call take at least `latency` seconds, like a network round trip."""
+    if latency <= 0:
+        return
+    for name in ("search", "search_threads", "create_user", "get_user", "get_chat_threads", "create_chat_thread",
+                 "get_chat_thread", "update_thread_summary", "save_messages", "get_messages_for_thread", "get_thread_centroid"):
+        method = getattr(db_client, name)
+
+        async def delayed(*args, _method=method, **kwargs):
+            await asyncio.sleep(latency)
+            return await _method(*args, **kwargs)
+        setattr(db_client, name, delayed)
+
+class LoopLagMonitor:
+    """Samples how late a sleep of `interval` seconds wakes up on the loop it runs on."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples: List[float] = []
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+class ServerThread(threading.Thread):
+    def __init__(self, app, port: int, lag_monitor: LoopLagMonitor):
+        super().__init__(daemon=True)
+        import uvicorn
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", ws_max_size=64 * 2**20))
+        self.lag_monitor = lag_monitor
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        monitor = asyncio.create_task(self.lag_monitor.run())
+        try:
+            await self.server.serve()
+        finally:
+            monitor.cancel()
+
+    def wait_started(self, timeout: float = 30.0):
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline or not self.is_alive():
+                raise SystemExit("Benchmark server failed to start")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.join()
+
+class LoadClient:
+    def __init__(self, index: int, url: str, turns: int, samples: Dict[str, Dict[str, List[float]]]):
+        self.index = index
+        self.url = url
+        self.turns = turns
+        self.samples = samples
+        self.completed_turns = 0
+        self.errors: List[str] = []
+
+    async def _request(self, ws, frame: Dict[str, Any], done) -> List[Dict[str, Any]]:
+        request_id = uuid.uuid4().hex
+        await ws.send(json.dumps({**frame, "request_id": request_id}))
+        frames = []
+        while True:
+            reply = json.loads(await ws.recv())
+            if reply.get("request_id") != request_id:
+                continue
+            frames.append(reply)
+            if reply.get("type") in ("error", "cancelled"):
+                raise RuntimeError(reply.get("error") or reply["type"])
+            if done(reply):
+                return frames
+
+    async def _timed(self, name: str, ws, frame: Dict[str, Any], done) -> List[Dict[str, Any]]:
+        start = time.perf_counter()
+        frames = await self._request(ws, frame, done)
+        self.samples["message_types"][name].append(time.perf_counter() - start)
+        return frames
+
+    async def _turn(self, ws, thread_id: str, turn: int):
+        request_id = uuid.uuid4().hex
+        start = last = time.perf_counter()
+        first_delta = None
+        await ws.send(json.dumps({"prompt": f"client {self.index} turn {turn}: what should I read next?", "thread_id": thread_id, "request_id": request_id}))
+        while True:
+            reply = json.loads(await ws.recv())
+            if reply.get("request_id") != request_id:
+                continue
+            now = time.perf_counter()
+            if reply.get("type") in ("error", "cancelled"):
+                raise RuntimeError(reply.get("error") or reply["type"])
+            if reply.get("type") == "chorus_delta":
+                if first_delta is None:
+                    first_delta = now - start
+                continue
+            step = reply.get("step")
+            if step == "error":
+                raise RuntimeError(reply.get("content"))
+            self.samples["chorus_steps"][step].append(now - last)
+            last = now
+            if step == "final":
+                break
+        self.samples["message_types"]["prompt"].append(time.perf_counter() - start)
+        if first_delta is not None:
+            self.samples["message_types"]["prompt_first_delta"].append(first_delta)
+        self.completed_turns += 1
+
+    async def run(self):
+        import websockets
+        try:
+            async with websockets.connect(self.url, max_size=None) as ws:
+                init = (await self._timed("init", ws, {"public_key": f"bench-{uuid.uuid4().hex}"}, lambda reply: reply.get("type") == "init"))[-1]
+                created = (await self._timed(
+                    "create_thread", ws, {"type": "create_thread", "user_id": init["user"]["id"], "name": f"bench {self.index}"},
+                    lambda reply: reply.get("type") == "new_thread"
+                ))[-1]
+                thread_id = created["chat_thread"]["id"]
+                get_messages = {"type": "get_thread_messages", "thread_id": thread_id}
+                await self._timed("get_thread_messages", ws, get_messages, lambda reply: reply.get("type") == "thread_messages")
+                for turn in range(self.turns):
+                    await self._turn(ws, thread_id, turn)
+                    await self._timed("get_thread_messages", ws, get_messages, lambda reply: reply.get("type") == "thread_messages")
+        except Exception as e:
+            self.errors.append(f"{type(e).__name__}: {e}")
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    values = np.asarray(samples) * 1000
+    return {
+        "count": int(len(values)),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+def compare(baseline: Dict[str, Any], report: Dict[str, Any]):
+    print(f"vs {baseline.get('commit') or 'baseline'}: turns/s {baseline['turns_per_second']} -> {report['turns_per_second']}")
+    for section in ("message_types", "chorus_steps"):
+        for name, row in report[section].items():
+            before = baseline.get(section, {}).get(name)
+            if before and before["p95_ms"]:
+                change = (row["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100
+                print(f"  {name:<22} p95 {before['p95_ms']:>9.1f} -> {row['p95_ms']:>9.1f} ms ({change:+.1f}%)")
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def drive(url: str, clients: int, turns: int, ramp: float) -> Dict[str, Any]:
+    samples: Dict[str, Dict[str, List[float]]] = {"message_types": defaultdict(list), "chorus_steps": defaultdict(list)}
+    load_clients = [LoadClient(index, url, turns, samples) for index in range(clients)]
+
+    async def start(client: LoadClient):
+        await asyncio.sleep(ramp * client.index / max(clients, 1))
+        await client.run()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(start(client) for client in load_clients))
+    duration = time.perf_counter() - started
+    turns_done = sum(client.completed_turns for client in load_clients)
+    return {
+        "duration_s": round(duration, 3),
+        "turns": turns_done,
+        "turns_per_second": round(turns_done / duration, 3) if duration else 0.0,
+        "errors": [error for client in load_clients for error in client.errors],
+        "message_types": {name: summarize(values) for name, values in sorted(samples["message_types"].items())},
+        "chorus_steps": {name: summarize(values) for name, values in samples["chorus_steps"].items()},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=10, help="concurrent websocket clients")
+    parser.add_argument("--turns", type=int, default=2, help="prompt turns per client")
+    parser.add_argument("--ramp", type=float, default=1.0, help="seconds over which clients connect")
+    parser.add_argument("--ttft", type=float, default=0.2, help="completion time to first token (s)")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--completion-tokens", type=int, default=40)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--db-latency", type=float, default=0.0, help="added to every storage call (s)")
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="earlier JSON report to compare p95 latencies against")
+    args = parser.parse_args()
+
+    # The app reads its Config at import time
+    os.environ["STORAGE_BACKEND"] = "local"
+    os.environ["PUBSUB_BACKEND"] = "inprocess"
+    os.environ["EMBEDDING_DIMENSION"] = str(args.dimension)
+    import utils
+    fake = FakeLLM(args.ttft, args.tokens_per_second, args.completion_tokens, args.embedding_latency, args.dimension)
+    utils.acompletion = fake.acompletion
+    utils.aembedding = fake.aembedding
+    import main as app_module
+    add_storage_latency(app_module.db_client, args.db_latency)
+
+    lag_monitor = LoopLagMonitor()
+    port = free_port()
+    server = ServerThread(app_module.app, port, lag_monitor)
+    server.start()
+    server.wait_started()
+    try:
+        report = asyncio.run(drive(f"ws://127.0.0.1:{port}/ws", args.clients, args.turns, args.ramp))
+    finally:
+        server.stop()
+
+    report = {
+        "commit": git_commit(),
+        "params": vars(args),
+        **report,
+        "upstream_calls": {"completions": fake.completions, "embeddings": fake.embeddings},
+        "event_loop_lag": summarize(lag_monitor.samples) if lag_monitor.samples else None,
+    }
+
+    print(f"{report['turns']} turns in {report['duration_s']}s = {report['turns_per_second']} turns/s, {len(report['errors'])} errors")
+    print(f"{'':<24} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    rows = [("type", report["message_types"]), ("step", report["chorus_steps"])]
+    if report["event_loop_lag"]:
+        rows.append(("loop", {"lag": report["event_loop_lag"]}))
+    for kind, section in rows:
+        for name, row in section.items():
+            print(f"{kind + ' ' + name:<24} {row['count']:>6} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}")
+    for error in report["errors"][:5]:
+        print(f"error: {error}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
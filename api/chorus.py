@@ -1,35 +1,74 @@
 import asyncio
+import contextvars
 from enum import Enum
-from typing import List, Dict, Any, Optional, Callable
+from typing import List, Dict, Any, Optional, Callable, Set
 from starlette.websockets import WebSocket, WebSocketState
 from config import Config
-from database import DatabaseClient
-from models import Message, ChorusState, ChorusStepEnum, ChorusResponse, Source
-from utils import logger, get_embedding, chat_completion, chunk_text
-from litellm import completion
+from backend import StorageBackend, next_sequence
+from persistence import MessageWriter
+from session_cache import SessionCache, history_registry
+from pubsub import PubSub, thread_channel
+from completion_cache import MISS, CompletionCache, completion_key
+from metrics import CHORUS_RUNS_IN_FLIGHT, CHORUS_RUNS_QUEUED, CHORUS_RUNS_REJECTED, COMPLETION_CACHE_LOOKUPS, span
+from context import ContextWindow
+from retrieval import RetrievalPipeline
+from scheduler import SchedulePolicy, StepScheduler
+from models import Message, ChatThread, ChorusState, ChorusStepEnum, ChorusResponse, ChorusDelta, Source, SearchFilter
+from utils import logger, get_embedding, stream_chat_completion
 from pydantic import BaseModel, ValidationError
 import json
 import uuid
 from datetime import datetime, timezone
 import traceback
 
+class ChorusRun:
+    """Everything one Chorus run mutates: its state, scheduler and client connection."""
+
+    def __init__(self, websocket: WebSocket, session: Optional[SessionCache] = None, origin: Optional[str] = None):
+        self.state = ChorusState()
+        self.scheduler = StepScheduler()
+        self.websocket = websocket
+        self.session = session
+        self.origin = origin
+
+# The run being executed by the current task; tasks started within a run inherit it
+_current_run: contextvars.ContextVar[ChorusRun] = contextvars.ContextVar("chorus_run")
+
 class Chorus:
     """
     The Chorus class implements the Chorus Loop, a decision-making model.
     It processes user prompts through a series of steps to generate refined responses.
+
+    One instance serves every connection. Per-run state lives in a ChorusRun
+    bound to the running task, so concurrent runs never see each other's
+    messages or steps. At most CHORUS_MAX_CONCURRENT_RUNS run at once; up to
+    CHORUS_MAX_QUEUED_RUNS more wait for a slot and the rest are turned away.
+    Committed messages and step results are also published as thread events
+    for every other socket watching the thread.
     """
 
-    def __init__(self, config: Config, db_client: DatabaseClient):
+    def __init__(self, config: Config, db_client: StorageBackend, message_writer: MessageWriter, pubsub: Optional[PubSub] = None):
         """
         Initialize the Chorus instance.
 
         Args:
             config (Config): Configuration settings.
-            db_client (DatabaseClient): Database client for storing and retrieving messages.
+            db_client (StorageBackend): Database client for storing and retrieving messages.
+            message_writer (MessageWriter): Write-behind queue that persists committed messages.
+            pubsub (PubSub): Fan-out of thread events to watching sockets, if any.
         """
         self.config = config
         self.db_client = db_client
-        self.state = ChorusState()
+        self.message_writer = message_writer
+        self.pubsub = pubsub
+        self.context_window = ContextWindow(config)
+        self.retrieval = RetrievalPipeline(config)
+        self.completion_cache = CompletionCache(config)
+        self._background_tasks: Set[asyncio.Task] = set()
+        self._summarizing: Set[str] = set()  # Threads with a summary update in flight
+        self.policy = SchedulePolicy.from_config(config)
+        self._admission = asyncio.Semaphore(config.CHORUS_MAX_CONCURRENT_RUNS)
+        self._queued = 0
         self.step_functions: List[Callable[[], asyncio.coroutine[ChorusResponse]]] = [
             self._action,
             self._experience,
@@ -38,46 +77,164 @@ class Chorus:
             self._update,
         ]
 
-    async def run(self, user_prompt: str, websocket: WebSocket, chat_history: List[Dict[str, str]], thread_id: str) -> List[Dict[str, str]]:
-        self.state.reset()
-        self.state.messages = chat_history + [{"role": "user", "content": user_prompt}]
+    @property
+    def _run_context(self) -> ChorusRun:
+        try:
+            return _current_run.get()
+        except LookupError:
+            raise RuntimeError("Chorus state accessed outside of a run")
+
+    @property
+    def state(self) -> ChorusState:
+        return self._run_context.state
+
+    @property
+    def scheduler(self) -> StepScheduler:
+        return self._run_context.scheduler
+
+    @property
+    def websocket(self) -> WebSocket:
+        return self._run_context.websocket
+
+    @property
+    def session(self) -> Optional[SessionCache]:
+        return self._run_context.session
+
+    async def run(self, user_prompt: str, websocket: WebSocket, chat_history: List[Message], thread_id: str, thread: Optional[ChatThread] = None, session: Optional[SessionCache] = None, origin: Optional[str] = None) -> List[Dict[str, str]]:
+        """
+        Run the Chorus loop for one prompt once a run slot is free. Cancelling
+        the calling task (e.g. when the client disconnects) stops the run and
+        its background work. `origin` tags the run's thread events so the
+        requesting connection can skip its own.
+        """
+        token = _current_run.set(ChorusRun(websocket, session, origin))
+        try:
+            if self._admission.locked() and self._queued >= self.config.CHORUS_MAX_QUEUED_RUNS:
+                logger.warning(f"Rejecting Chorus run: {self._queued} runs already queued")
+                CHORUS_RUNS_REJECTED.inc()
+                await self._send_result(websocket, ChorusResponse(step=ChorusStepEnum.ERROR, content="The server is busy, please try again shortly."))
+                return []
+            self._queued += 1
+            CHORUS_RUNS_QUEUED.inc()
+            try:
+                await self._admission.acquire()
+            finally:
+                self._queued -= 1
+                CHORUS_RUNS_QUEUED.dec()
+            CHORUS_RUNS_IN_FLIGHT.inc()
+            try:
+                async with span("chorus.run", thread_id=thread_id, history=len(chat_history)):
+                    return await self._run(user_prompt, websocket, chat_history, thread_id, thread)
+            finally:
+                CHORUS_RUNS_IN_FLIGHT.dec()
+                self._admission.release()
+        finally:
+            _current_run.reset(token)
+
+    async def _run(self, user_prompt: str, websocket: WebSocket, chat_history: List[Message], thread_id: str, thread: Optional[ChatThread]) -> List[Dict[str, str]]:
+        summary = thread.summary if thread else None
+        summary_seq = thread.summary_seq if thread else None
+        older, recent = self.context_window.split(chat_history)
+        self.state.messages = self.context_window.build(recent, summary) + [{"role": "user", "content": user_prompt}]
         self.state.thread_id = thread_id
+        self.state.user_id = thread.user_id if thread else None
+        self.state.user_prompt = user_prompt
+
+        unsummarized = [message for message in older if summary_seq is None or (message.seq or 0) > summary_seq]
+        # History stops at CONTEXT_HISTORY_LIMIT; stored messages before it may not be in the summary yet either
+        truncated = len(chat_history) >= self.config.CONTEXT_HISTORY_LIMIT and (summary_seq is None or summary_seq < (chat_history[0].seq or 0))
+        if (unsummarized or truncated) and thread_id not in self._summarizing:
+            self._summarizing.add(thread_id)
+            self._spawn(self._update_summary(thread_id, summary, summary_seq, chat_history[0] if truncated else None, unsummarized))
 
         # Save the user prompt
         await self._commit_message("user", user_prompt, step=ChorusStepEnum.ACTION.value)
 
+        if self.policy.prefetch_experience:
+            self.scheduler.start("experience_search", self._search_memory(user_prompt))
+
         try:
-            for step_function in self.step_functions:
-                if websocket.client_state != WebSocketState.CONNECTED:
-                    logger.warning("WebSocket disconnected. Stopping Chorus loop.")
-                    break
-                result = await step_function()
-                await self._send_result(websocket, result)
-                await asyncio.sleep(0.1)  # Prevent steps from bunching together
-
-                if step_function == self._update:
-                    if result.content.lower() == "return":
-                        final_response = await self._yield()
-                        await self._send_result(websocket, final_response)
-                        await asyncio.sleep(0.1)
-                        self.state.complete()
-                    elif result.content.lower() == "loop":
-                        self.state.loop()
-                    else:
-                        logger.error(f"Unexpected result from update step: {result.content}")
-                        final_response = await self._yield()
+            loops = 0
+            while not self.state.is_complete:
+                for step_function in self.step_functions:
+                    if websocket.client_state != WebSocketState.CONNECTED:
+                        logger.warning("WebSocket disconnected. Stopping Chorus loop.")
+                        return self.state.messages
+
+                    if step_function == self._update and self.policy.speculative_yield:
+                        # Yield does not need Update's verdict, only the context before it
+                        self.scheduler.start("yield", self._generate_yield(list(self.state.messages), stream=False))
+
+                    async with self.scheduler.timed(step_function.__name__.lstrip("_")):
+                        result = await step_function()
+                    await self._send_result(websocket, result)
+                    if self.policy.step_delay:
+                        await asyncio.sleep(self.policy.step_delay)
+
+                    if step_function == self._update:
+                        decision = result.content.strip().lower()
+                        if decision == "loop" and loops < self.policy.max_loops:
+                            loops += 1
+                            self.scheduler.discard("yield")
+                            self.state.loop()
+                            break
+                        if decision not in ("return", "loop"):
+                            logger.error(f"Unexpected result from update step: {result.content}")
+                        async with self.scheduler.timed("yield"):
+                            final_response = await self._yield()
                         await self._send_result(websocket, final_response)
-                        await asyncio.sleep(0.1)
                         self.state.complete()
+        except asyncio.CancelledError:
+            logger.info(f"Chorus run for thread {thread_id} cancelled")
+            self.state.interrupt()
+            raise
         except Exception as e:
             error_msg = f"Error in Chorus run: {str(e)}\n{traceback.format_exc()}"
             logger.error(error_msg)
             if websocket.client_state == WebSocketState.CONNECTED:
                 error_response = ChorusResponse(step=ChorusStepEnum.ERROR, content=f"An error occurred: {str(e)}")
                 await self._send_result(websocket, error_response)
+        finally:
+            await self.scheduler.close()
+            logger.info(f"Chorus step timings (s): { {name: round(seconds, 3) for name, seconds in self.scheduler.timings.items()} }")
 
         return self.state.messages
 
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _update_summary(self, thread_id: str, summary: Optional[str], summary_seq: Optional[int], window_start: Optional[Message], older: List[Message]):
+        """
+        Fold everything after summary_seq that is out of the context window
+        into the summary, oldest first and one token budget at a time, storing
+        the summary after each step so progress survives a failure.
+        """
+        try:
+            behind = await self._unsummarized_before(thread_id, summary_seq, window_start) if window_start is not None else []
+            for batch in self.context_window.batches(behind + older):
+                new_summary = await self.context_window.summarize(summary, batch)
+                if not new_summary or batch[-1].seq is None:
+                    return
+                await self.db_client.update_thread_summary(thread_id, new_summary, batch[-1].seq)
+                summary = new_summary
+        finally:
+            self._summarizing.discard(thread_id)
+
+    async def _unsummarized_before(self, thread_id: str, summary_seq: Optional[int], window_start: Message) -> List[Message]:
+        """Stored messages older than the history window and newer than summary_seq, oldest first."""
+        limit = self.config.CONTEXT_HISTORY_LIMIT
+        messages: List[Message] = []
+        before, before_id = window_start.seq, window_start.id
+        while True:
+            page = await self.db_client.get_messages_for_thread(thread_id, before=before, before_id=before_id, limit=limit)
+            fresh = [message for message in page if summary_seq is None or (message.seq or 0) > summary_seq]
+            messages[:0] = fresh
+            if len(page) < limit or len(fresh) < len(page):
+                return messages
+            before, before_id = page[0].seq, page[0].id
+
     async def _action(self) -> ChorusResponse:
         action_prompt = """
         This is the Chorus Loop, a decision-making model that turns the OODA loop on its head.
@@ -86,7 +243,7 @@ class Chorus:
         This is step 1, Action: Provide an initial response to the user's prompt to the best of your ability.
         Return your response.
         """
-        result = await self._structured_chat_completion(self.state.messages + [{"role": "system", "content": action_prompt}])
+        result = await self._structured_chat_completion(self.state.messages + [{"role": "system", "content": action_prompt}], ChorusStepEnum.ACTION)
         logger.info(f"Action step result: {result}")
 
         # Save the assistant's response
@@ -100,8 +257,10 @@ class Chorus:
         Return your response containing your refined response.
         """
         prompt = self.state.messages[-1]["content"]
-        embedding = await get_embedding(prompt, self.config.EMBEDDING_MODEL)
-        search_results = await self.db_client.search(embedding)
+        if self.scheduler.has("experience_search"):
+            search_results = await self.scheduler.result("experience_search")
+        else:
+            search_results = await self._search_memory(self.state.user_prompt)
         search_results_str = "\n".join([result['content'] for result in search_results])
 
         sources = []
@@ -127,19 +286,44 @@ class Chorus:
         result = await self._structured_chat_completion(self.state.messages + [
             {"role": "system", "content": experience_prompt},
             {"role": "user", "content": reranked_prompt}
-        ])
+        ], ChorusStepEnum.EXPERIENCE)
 
         # Save the assistant's response
         await self._commit_message("assistant", result.content, step=ChorusStepEnum.EXPERIENCE.value)
 
         return ChorusResponse(step=ChorusStepEnum.EXPERIENCE, content=result.content, sources=sources)
 
+    async def _search_memory(self, query: str) -> List[Dict[str, Any]]:
+        scope = self.config.CHORUS_SEARCH_SCOPE
+        if (scope == "user" and not self.state.user_id) or (scope == "thread" and not self.state.thread_id):
+            # Searching without the owner would silently widen the scope to every message
+            logger.warning(f"No {scope} to scope the experience search to; skipping it")
+            return []
+        embedding = await get_embedding(query, self.config.EMBEDDING_MODEL)
+        filters = self.retrieval.scope_filter(self.state.thread_id, self.state.user_id)
+        if self.config.CHORUS_THREAD_SEARCH_LIMIT > 0 and not (filters and filters.thread_ids):
+            # Two-stage search: pick the nearest threads by centroid, then search only their messages
+            threads = await self.db_client.search_threads(
+                embedding,
+                self.config.CHORUS_THREAD_SEARCH_LIMIT,
+                user_id=filters.user_id if filters else None
+            )
+            if threads:
+                thread_ids = [thread["id"] for thread in threads]
+                if self.state.thread_id and self.state.thread_id not in thread_ids:
+                    thread_ids.append(self.state.thread_id)
+                filters = (filters or SearchFilter()).model_copy(update={"thread_ids": thread_ids})
+        results = await self.db_client.search(embedding, with_vectors=True, filters=filters)
+        selected = self.retrieval.select(results)
+        logger.info(f"Selected {len(selected)} of {len(results)} search results for context")
+        return selected
+
     async def _intention(self) -> ChorusResponse:
         intention_prompt = """
         This is step 3 of the Chorus Loop, Intention: Analyze your planned actions and consider potential consequences.
         Return your response containing your analysis and intentions.
         """
-        result = await self._structured_chat_completion(self.state.messages + [{"role": "system", "content": intention_prompt}])
+        result = await self._structured_chat_completion(self.state.messages + [{"role": "system", "content": intention_prompt}], ChorusStepEnum.INTENTION)
         logger.info(f"Intention step result: {result}")
 
         # Save the assistant's response
@@ -153,7 +337,7 @@ class Chorus:
         Identify any gaps in your knowledge or potential biases.
         Return your response containing your observations and reflections.
         """
-        result = await self._structured_chat_completion(self.state.messages + [{"role": "system", "content": observation_prompt}])
+        result = await self._structured_chat_completion(self.state.messages + [{"role": "system", "content": observation_prompt}], ChorusStepEnum.OBSERVATION)
         logger.info(f"Observation step result: {result}")
 
         # Save the assistant's response
@@ -167,7 +351,7 @@ class Chorus:
         decide whether to proceed with your current plan or loop back for further refinement.
         If you believe your response is ready, return "RETURN". If you need another iteration, return "LOOP".
         """
-        result = await self._structured_chat_completion(self.state.messages + [{"role": "system", "content": update_prompt}])
+        result = await self._structured_chat_completion(self.state.messages + [{"role": "system", "content": update_prompt}], ChorusStepEnum.UPDATE)
         logger.info(f"Update step result: {result}")
 
         # Save the assistant's response
@@ -176,47 +360,70 @@ class Chorus:
         return ChorusResponse(step=ChorusStepEnum.UPDATE, content=result.content)
 
     async def _yield(self) -> ChorusResponse:
+        if self.scheduler.has("yield"):
+            result = await self.scheduler.take("yield")
+            # The speculative run was not streamed; deliver it as a single delta
+            await self._send_delta(ChorusStepEnum.FINAL, result.content)
+        else:
+            result = await self._generate_yield(self.state.messages)
+        self.state.current_step = ChorusStepEnum.FINAL
+        logger.info(f"Yield step result: {result}")
+
+        # Save the assistant's final response
+        await self._commit_message("assistant", result.content, step=ChorusStepEnum.FINAL.value)
+
+        return ChorusResponse(step=ChorusStepEnum.FINAL, content=result.content)
+
+    async def _generate_yield(self, messages: List[Dict[str, str]], stream: bool = True) -> ChorusResponse:
         yield_prompt = """
         This is the final step of the Chorus Loop, Yield: Synthesize the accumulated context
         from all iterations and provide a final response that comprehensively addresses
         the user's original prompt. Return your response containing your synthesized response.
         """
-        result = await self._structured_chat_completion(self.state.messages + [
+        return await self._structured_chat_completion(messages + [
             {"role": "system", "content": yield_prompt},
             {"role": "user", "content": "Write a final response to the user's prompt:"}
-        ])
-        logger.info(f"Yield step result: {result}")
-
-        # Save the assistant's final response
-        await self._commit_message("assistant", result.content, step=ChorusStepEnum.FINAL.value)
-
-        return ChorusResponse(step=ChorusStepEnum.FINAL, content=result.content)
+        ], ChorusStepEnum.FINAL, stream=stream)
 
     async def _commit_message(self, role: str, content: str, step: str, embedding: Optional[List[float]] = None):
-        if embedding is None:
-            embedding = await get_embedding(content, self.config.EMBEDDING_MODEL)
-
-        if not embedding:
-            logger.error("Failed to generate embedding for the message.")
-            return
-
         message = Message(
             id=str(uuid.uuid4()),
             thread_id=self.state.thread_id,
+            user_id=self.state.user_id,
             role=role,
             content=content,
             created_at=datetime.utcnow().isoformat(),
             vector=embedding,
-            step=step
+            step=step,
+            seq=next_sequence()
         )
         self.state.messages.append({"role": role, "content": content, "step": step})
-        await self.db_client.save_message(message)
+        # Keep cached thread histories current before the write lands
+        if self.session is not None:
+            self.session.record(message)
+        else:
+            history_registry.publish(message)
+        await self._publish_thread_event({"type": "thread_message", "message": message.dict(exclude={"vector"})})
+        # Embedding and storage happen in the background writer
+        await self.message_writer.enqueue(message)
+
+    async def _publish_thread_event(self, event: Dict[str, Any]):
+        if self.pubsub is None or not self.state.thread_id:
+            return
+        try:
+            await self.pubsub.publish(
+                thread_channel(self.state.thread_id),
+                {**event, "thread_id": self.state.thread_id, "origin": self._run_context.origin}
+            )
+        except Exception as e:
+            logger.error(f"Error publishing {event.get('type')} event: {e}")
 
     async def _send_result(self, websocket: WebSocket, response: ChorusResponse):
+        response_data = response.model_dump()
+        response_data['isStreaming'] = self.state.current_step != ChorusStepEnum.FINAL
+        await self._publish_thread_event({"type": "thread_step", "result": response_data})
         if websocket.client_state == WebSocketState.CONNECTED:
             try:
-                response_data = json.loads(response.to_json())
-                response_data['isStreaming'] = self.state.current_step != ChorusStepEnum.FINAL
                 await websocket.send_json(response_data)
                 logger.info(f"Sent {response.step} result to client.")
             except Exception as e:
@@ -224,22 +431,56 @@ class Chorus:
         else:
             logger.warning("WebSocket is not connected. Skipping message send.")
 
-    async def _structured_chat_completion(self, messages: List[Dict[str, str]], response_format: BaseModel = None) -> ChorusResponse:
+    async def _send_delta(self, step: ChorusStepEnum, content: str):
+        websocket = self.websocket
+        if websocket is None or websocket.client_state != WebSocketState.CONNECTED:
+            return
         try:
-            response = completion(
-                model=self.config.CHAT_MODEL,
-                messages=messages,
-                max_tokens=self.config.MAX_TOKENS,
-                temperature=self.config.TEMPERATURE
-            )
-            content = response.choices[0].message.content
+            await websocket.send_json(ChorusDelta(step=step.value, content=content).model_dump())
+        except Exception as e:
+            logger.error(f"Error sending delta to client: {e}")
+
+    async def _structured_chat_completion(self, messages: List[Dict[str, str]], step: ChorusStepEnum, response_format: BaseModel = None, stream: bool = True) -> ChorusResponse:
+        """
+        Run a streaming completion for one step, forwarding each token delta to the
+        client as a ChorusDelta frame unless `stream` is off (speculative work),
+        and return the assembled step response.
+        """
+        if stream:
+            self.state.current_step = step
+        try:
+            content = await self._complete(messages, step, stream)
             try:
                 parsed_content = json.loads(content)
                 if isinstance(parsed_content, dict) and 'content' in parsed_content:
                     content = parsed_content['content']
             except json.JSONDecodeError:
                 pass  # Content is not JSON, use as is
-            return ChorusResponse(step=self.state.current_step.value, content=content)
+            return ChorusResponse(step=step.value, content=content)
         except Exception as e:
             logger.error(f"Error in structured chat completion: {str(e)}")
             return ChorusResponse(step=ChorusStepEnum.ERROR.value, content=f"An error occurred: {str(e)}")
+
+    async def _complete(self, messages: List[Dict[str, str]], step: ChorusStepEnum, stream: bool) -> str:
+        async def generate() -> str:
+            parts = []
+            async for delta in stream_chat_completion(
+                messages=messages,
+                model=self.config.CHAT_MODEL,
+                max_tokens=self.config.MAX_TOKENS,
+                temperature=self.config.TEMPERATURE
+            ):
+                parts.append(delta)
+                if stream:
+                    await self._send_delta(step, delta)
+            return "".join(parts)
+
+        if not self.completion_cache.enabled:
+            return await generate()
+        key = completion_key(self.config.CHAT_MODEL, self.config.TEMPERATURE, self.config.MAX_TOKENS, messages)
+        content, outcome = await self.completion_cache.get_or_compute(key, self.config.TEMPERATURE, generate)
+        COMPLETION_CACHE_LOOKUPS.labels(outcome).inc()
+        if outcome != MISS and stream:
+            # A cached or coalesced result was never streamed to this client; deliver it as a single delta
+            await self._send_delta(step, content)
+        return content
@@ -0,0 +1,117 @@
+import re
+from functools import lru_cache
+from typing import Iterator, List, NamedTuple, Sequence
+import tiktoken
+from config import Config
+
+PARAGRAPH = re.compile(r"\n\s*\n")
+SENTENCE = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+# Coarsest to finest; a unit too long for one chunk is split at the next level down
+BOUNDARIES = {
+    "paragraph": (PARAGRAPH, SENTENCE),
+    "sentence": (SENTENCE,),
+    "none": (),
+}
+
+class TextChunk(NamedTuple):
+    text: str
+    tokens: int
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str) -> tiktoken.Encoding:
+    return tiktoken.get_encoding(name)
+
+def _split(text: str, pattern: re.Pattern) -> Iterator[str]:
+    """Lazily split after each match, keeping the separator with the piece before it."""
+    start = 0
+    for match in pattern.finditer(text):
+        yield text[start:match.end()]
+        start = match.end()
+    if start < len(text):
+        yield text[start:]
+
+class Chunker:
+    """
+    Splits text into chunks of at most `max_tokens` tokens of the embedding
+    model's encoding, consecutive chunks sharing about `overlap` tokens.
+    Chunks are packed from whole paragraphs or sentences where they fit, and
+    only a unit longer than a whole chunk is cut mid-sentence. Chunks are
+    yielded lazily, so callers can stream them into batches.
+    """
+
+    def __init__(self, max_tokens: int, overlap: int = 0, boundary: str = "sentence", encoding: str = "cl100k_base"):
+        if boundary not in BOUNDARIES:
+            raise ValueError(f"Unknown chunk boundary: {boundary}")
+        if not 0 <= overlap < max_tokens:
+            raise ValueError(f"Chunk overlap ({overlap}) must be smaller than the chunk size ({max_tokens})")
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+        self.levels = BOUNDARIES[boundary]
+        self.encoding = get_encoding(encoding)
+
+    @classmethod
+    def from_config(cls, config: Config, max_tokens: int = 0) -> "Chunker":
+        """Chunks of `max_tokens` (CHUNK_SIZE by default), never above the model's EMBEDDING_MAX_TOKENS."""
+        return cls(
+            min(max_tokens or config.CHUNK_SIZE, config.EMBEDDING_MAX_TOKENS),
+            config.CHUNK_OVERLAP,
+            config.CHUNK_BOUNDARY,
+            config.EMBEDDING_ENCODING
+        )
+
+    def count(self, text: str) -> int:
+        return len(self._encode(text))
+
+    def chunks(self, text: str) -> Iterator[TextChunk]:
+        window: List[Sequence[int]] = []
+        size = 0
+        fresh = False  # Whether the window holds anything beyond the previous chunk's overlap
+        for tokens in self._units(text, self.levels):
+            if size + len(tokens) > self.max_tokens and fresh:
+                chunk = self._chunk(window, size)
+                if chunk.text:
+                    yield chunk
+                window = self._tail(window)
+                size = sum(len(unit) for unit in window)
+                fresh = False
+            window.append(tokens)
+            size += len(tokens)
+            fresh = True
+        if fresh:
+            chunk = self._chunk(window, size)
+            if chunk.text:
+                yield chunk
+
+    def _units(self, text: str, levels: Sequence[re.Pattern]) -> Iterator[Sequence[int]]:
+        pieces = _split(text, levels[0]) if levels else (text,)
+        # Units are cut to leave room for the overlap carried in front of them
+        step = self.max_tokens - self.overlap
+        for piece in pieces:
+            tokens = self._encode(piece)
+            if len(tokens) <= step:
+                yield tokens
+            elif len(levels) > 1:
+                yield from self._units(piece, levels[1:])
+            else:
+                for start in range(0, len(tokens), step):
+                    yield tokens[start:start + step]
+
+    def _tail(self, window: List[Sequence[int]]) -> List[Sequence[int]]:
+        """The trailing whole units that fit in the overlap, or the last tokens of the final unit."""
+        if not self.overlap:
+            return []
+        tail: List[Sequence[int]] = []
+        size = 0
+        for unit in reversed(window):
+            if size + len(unit) > self.overlap:
+                break
+            tail.insert(0, unit)
+            size += len(unit)
+        return tail or [window[-1][-self.overlap:]]
+
+    def _encode(self, text: str) -> List[int]:
+        return self.encoding.encode(text, disallowed_special=())
+
+    def _chunk(self, window: List[Sequence[int]], size: int) -> TextChunk:
+        tokens = [token for unit in window for token in unit]
+        return TextChunk(self.encoding.decode(tokens).strip(), size)
@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from config import Config
+from utils import logger
+
+HIT = "hit"
+COALESCED = "coalesced"
+MISS = "miss"
+
+def completion_key(model: str, temperature: float, max_tokens: int, messages: List[Dict[str, str]]) -> str:
+    """
+    Hash of everything that determines a completion. Messages are reduced to
+    the fields the model sees, so bookkeeping keys such as "step" do not split
+    otherwise identical requests.
+    """
+    canonical = [
+        {field: message[field] for field in ("role", "content", "name") if message.get(field) is not None}
+        for message in messages
+    ]
+    payload = json.dumps(
+        {"model": model, "temperature": temperature, "max_tokens": max_tokens, "messages": canonical},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class CompletionCache:
+    """
+    TTL + LRU cache of finished chat completions, plus coalescing of identical
+    requests already in flight: the first caller (the leader) calls the model
+    and every concurrent duplicate waits for its result instead of making a
+    second upstream call. If the leader is cancelled, a waiting duplicate takes
+    over. Completions sampled at temperature > 0 are shared between concurrent
+    duplicates but only stored when COMPLETION_CACHE_SAMPLED is set.
+    """
+
+    def __init__(self, config: Config):
+        self.max_entries = config.COMPLETION_CACHE_SIZE
+        self.ttl = config.COMPLETION_CACHE_TTL
+        self.cache_sampled = config.COMPLETION_CACHE_SAMPLED
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, content = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return content
+
+    def put(self, key: str, content: str):
+        self._entries[key] = (time.monotonic() + self.ttl, content)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_compute(self, key: str, temperature: float, compute: Callable[[], Awaitable[str]]) -> Tuple[str, str]:
+        """
+        The completion for `key` and how this caller got it: HIT from the
+        cache, COALESCED from a concurrent leader, or MISS if it ran `compute`
+        itself. `compute`
+        runs in the caller's task, so a leader streams to its own client while
+        duplicates wait; it should raise rather than return a failed result.
+        """
+        while True:
+            cached = self.get(key)
+            if cached is not None:
+                return cached, HIT
+            future = self._inflight.get(key)
+            if future is None:
+                break
+            try:
+                content = await asyncio.shield(future)
+                self.coalesced += 1
+                return content, COALESCED
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                logger.info("Coalesced completion leader was cancelled; retrying")
+            except Exception:
+                # The leader failed; this caller tries again, possibly as the new leader
+                continue
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            content = await compute()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()  # Mark retrieved; waiters re-raise it themselves
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        future.set_result(content)
+        if temperature <= 0 or self.cache_sampled:
+            self.put(key, content)
+        return content, MISS
@@ -1,28 +1,106 @@
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 from pydantic_settings import BaseSettings
 
 load_dotenv()
 
 class Config(BaseSettings):
+    STORAGE_BACKEND: str = "qdrant"  # "qdrant" or "local" (in-process, for tests and single-node runs)
     QDRANT_URL: str = os.getenv("QDRANT_URL", "http://localhost:6333")
     QDRANT_API_KEY: str = os.getenv("QDRANT_API_KEY", "")
+    QDRANT_PREFER_GRPC: bool = False
+    QDRANT_GRPC_PORT: int = 6334
+    QDRANT_TIMEOUT: int = 30
+    QDRANT_MAX_CONNECTIONS: int = 100
+    QDRANT_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    QDRANT_KEEPALIVE_EXPIRY: float = 30.0
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
     AZURE_API_KEY: str = os.getenv("AZURE_API_KEY", "")
     AZURE_API_BASE: str = os.getenv("AZURE_API_BASE", "")
     AZURE_API_VERSION: str = "2024-02-15-preview"
     EMBEDDING_MODEL: str = "choir-embeddings-ada-002"
+    EMBEDDING_DIMENSION: int = 1536
+    EMBEDDING_BATCH_SIZE: int = 16  # Chunks per embedding request
+    EMBEDDING_BATCH_TOKENS: int = 100000  # Tokens per embedding request
+    EMBEDDING_MAX_TOKENS: int = 8000  # Per-input limit, a margin below ada-002's 8191
+    EMBEDDING_ENCODING: str = "cl100k_base"  # tiktoken encoding of EMBEDDING_MODEL
+    EMBEDDING_CONCURRENCY: int = 4
+    EMBEDDING_CACHE_SIZE: int = 4096
+    EMBEDDING_CACHE_PATH: str = ""  # SQLite file for the persistent tier; empty keeps the cache in memory only
     CHAT_MODEL: str = "azure/choir-gpt-4o"
     MAX_TOKENS: int = 4000
     TEMPERATURE: float = 0.7
+    COMPLETION_CACHE_SIZE: int = 1024  # 0 disables caching and coalescing of chat completions
+    COMPLETION_CACHE_TTL: float = 600.0
+    COMPLETION_CACHE_SAMPLED: bool = False  # Also store completions sampled at temperature > 0
     MESSAGES_COLLECTION: str = "choir"
     CHAT_THREADS_COLLECTION: str = "chat_threads"
     USERS_COLLECTION: str = "users"
+    SCHEMA_BOOTSTRAP: bool = True
     SEARCH_LIMIT: int = 80
-    CHUNK_SIZE: int = 10000
-    CHUNK_OVERLAP: int = 5000
+    MESSAGES_QUANTIZATION: str = "none"  # "none", "scalar" (int8) or "binary"
+    MESSAGES_VECTORS_ON_DISK: bool = False  # Keep float32 originals on disk; quantized copies stay in RAM
+    SEARCH_RESCORE: bool = True
+    SEARCH_OVERSAMPLING: float = 2.0
+    CHORUS_SEARCH_SCOPE: str = "global"  # "global", "user" or "thread"
+    CHORUS_SEARCH_RECENCY_DAYS: int = 0  # 0 searches all history
+    CHORUS_SEARCH_ROLE: str = ""
+    CHORUS_SEARCH_STEP: str = ""
+    CHORUS_THREAD_SEARCH_LIMIT: int = 0  # >0 searches messages only in this many threads nearest by centroid
+    RELATED_THREADS_LIMIT: int = 5
+    RETRIEVAL_TOP_K: int = 12
+    RETRIEVAL_MMR_LAMBDA: float = 0.7
+    RETRIEVAL_MIN_SCORE: float = 0.0
+    RETRIEVAL_DUPLICATE_THRESHOLD: float = 0.97
+    RETRIEVAL_TOKEN_BUDGET: int = 2000
+    MESSAGES_PAGE_SIZE: int = 256
+    THREAD_PAGE_SIZE: int = 50
+    THREAD_PAGE_MAX: int = 500
+    CONTEXT_HISTORY_LIMIT: int = 100
+    SESSION_CACHE_THREADS: int = 8  # Threads whose history each connection keeps in memory
+    # Check the stored head before reusing a cached history; only other workers' writes can be missed, so on with Redis pub/sub
+    SESSION_CACHE_HEAD_CHECK: bool = os.getenv("PUBSUB_BACKEND", "inprocess") == "redis"
+    CONTEXT_TOKEN_BUDGET: int = 6000
+    SUMMARY_MAX_TOKENS: int = 512
+    CHUNK_SIZE: int = 1024  # Tokens per ingested chunk; capped at EMBEDDING_MAX_TOKENS
+    CHUNK_OVERLAP: int = 128  # Tokens shared by consecutive chunks, for ingestion and over-limit texts alike
+    CHUNK_BOUNDARY: str = "sentence"  # Pack chunks from whole "paragraph"s, "sentence"s, or "none" (raw tokens)
+    CHORUS_PREFETCH_EXPERIENCE: bool = True
+    CHORUS_SPECULATIVE_YIELD: bool = True
+    CHORUS_STEP_DELAY: float = 0.0
+    CHORUS_MAX_LOOPS: int = 1
+    CHORUS_MAX_CONCURRENT_RUNS: int = 16  # Runs executing at once in this process
+    CHORUS_MAX_QUEUED_RUNS: int = 64  # Runs waiting for a slot before new ones are rejected
+    CONNECTION_MAX_CONCURRENT_REQUESTS: int = 4  # Requests one websocket may have running at once
+    CONNECTION_MAX_PENDING_REQUESTS: int = 32  # Requests one websocket may have running or waiting before new ones are rejected
+    CONNECTION_MAX_WATCHED_THREADS: int = 8  # Threads whose events one websocket receives
+    PUBSUB_BACKEND: str = "inprocess"  # "inprocess" (single worker) or "redis" (multi-worker / multi-node)
+    PUBSUB_QUEUE_SIZE: int = 256
+    REDIS_URL: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    LOCK_TIMEOUT: float = 10.0  # Seconds before a Redis lock whose holder died expires
+    LOCK_WAIT_TIMEOUT: float = 5.0  # Seconds to wait for a Redis lock before giving up
+    METRICS_LOOP_LAG_INTERVAL: float = 0.5  # Seconds between event-loop lag samples; 0 disables
+    TRACE_EXPORT_PATH: str = os.getenv("TRACE_EXPORT_PATH", "")  # JSONL file for spans; empty disables tracing
+    INGEST_BATCH_SIZE: int = 256  # Chunks per embed + bulk upsert batch
+    INGEST_CONCURRENCY: int = 4  # Batches in flight; embedding requests are still capped by EMBEDDING_CONCURRENCY
+    INGEST_MAX_RETRIES: int = 3
+    INGEST_DEDUP_SIZE: int = 100000  # Chunk ids remembered for in-run dedup; older repeats fall back to a storage lookup
+    INGEST_REPORT_INTERVAL: float = 10.0  # Seconds between progress log lines
+    INGEST_ROOT: str = os.getenv("INGEST_ROOT", "")  # Directory POST /ingest may read from; empty disables the endpoint
+    PERSIST_QUEUE_SIZE: int = 1000
+    PERSIST_BATCH_SIZE: int = 32
+    PERSIST_FLUSH_INTERVAL: float = 0.05
+    PERSIST_MAX_RETRIES: int = 3
+    PERSIST_RETRY_BACKOFF: float = 0.5
+    PERSIST_SHUTDOWN_TIMEOUT: float = 30.0
     API_URL: str = os.getenv('API_URL', 'http://localhost:8000')
 
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
+
+@lru_cache(maxsize=1)
+def get_config() -> Config:
+    """Process-wide Config, read from the environment once."""
+    return Config()
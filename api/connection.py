@@ -0,0 +1,313 @@
+import asyncio
+import uuid
+from collections import OrderedDict
+from contextlib import suppress
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+from fastapi import WebSocket
+from starlette.websockets import WebSocketDisconnect, WebSocketState
+from config import Config
+from backend import StorageBackend
+from chorus import Chorus
+from metrics import WS_CONNECTIONS, WS_FRAME_BYTES, WS_REQUESTS_IN_FLIGHT
+from models import Message
+from pubsub import PubSub, Subscription, thread_channel
+from session_cache import SessionCache
+from utils import logger
+from wire import Codec
+
+class RequestChannel:
+    """
+    The websocket as seen by one request: every frame sent through it carries
+    the request's request_id and goes through the connection's send lock.
+    """
+
+    def __init__(self, connection: "Connection", request_id: Optional[str]):
+        self.connection = connection
+        self.request_id = request_id
+
+    @property
+    def client_state(self) -> WebSocketState:
+        return self.connection.websocket.client_state
+
+    async def send_json(self, data: Dict[str, Any]):
+        await self.connection.send_json(data, self.request_id)
+
+class Connection:
+    """
+    One /ws client. Frames may carry a request_id; each request runs as its own
+    task, at most CONNECTION_MAX_CONCURRENT_REQUESTS at a time, and every reply
+    frame echoes the request_id. A long Chorus run therefore no longer blocks
+    the client's other requests, and {"type": "cancel", "request_id": ...}
+    stops a request in flight. Frames without a request_id are answered
+    untagged and handled one after another in the order received, since
+    clients that don't tag requests match replies by order. Beyond
+    CONNECTION_MAX_PENDING_REQUESTS running or waiting, new requests are
+    rejected with an error frame.
+
+    The connection also watches the threads it opens or prompts (up to
+    CONNECTION_MAX_WATCHED_THREADS, or explicitly via watch_thread) and relays
+    their events published from any other connection or worker as
+    thread_message and thread_step frames.
+    """
+
+    def __init__(self, websocket: WebSocket, config: Config, db_client: StorageBackend, chorus: Chorus, pubsub: PubSub, subprotocol: Optional[str] = None):
+        self.id = str(uuid.uuid4())
+        self.websocket = websocket
+        self.codec = Codec(subprotocol)
+        self.config = config
+        self.db_client = db_client
+        self.chorus = chorus
+        self.pubsub = pubsub
+        self.session = SessionCache(config, db_client)
+        self._watches: "OrderedDict[str, Tuple[Subscription, asyncio.Task]]" = OrderedDict()
+        self._send_lock = asyncio.Lock()
+        self._slots = asyncio.Semaphore(config.CONNECTION_MAX_CONCURRENT_REQUESTS)
+        self._requests: Dict[str, asyncio.Task] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._untagged: Optional[asyncio.Task] = None  # Latest untagged request; the next one waits for it
+
+    async def serve(self):
+        WS_CONNECTIONS.inc()
+        try:
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+                frame = message["text"] if message.get("text") is not None else message.get("bytes") or b""
+                WS_FRAME_BYTES.labels("receive").observe(len(frame))
+                try:
+                    data = self.codec.decode(frame)
+                except ValueError as e:
+                    await self.send_json({"type": "error", "error": f"Invalid {self.codec.encoding} frame: {e}"})
+                    continue
+                if not isinstance(data, dict):
+                    await self.send_json({"type": "error", "error": "Frames must be objects"})
+                    continue
+                logger.info(f"Received data: {data}")
+                await self._dispatch(data)
+        except WebSocketDisconnect:
+            logger.info("WebSocket disconnected")
+        except Exception as e:
+            logger.error(f"Error: {str(e)}")
+            with suppress(Exception):
+                await self.send_json({"type": "error", "error": str(e)})
+        finally:
+            WS_CONNECTIONS.dec()
+            await self.close()
+
+    async def close(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with suppress(asyncio.CancelledError, Exception):
+                await task
+        for thread_id in list(self._watches):
+            await self._unwatch(thread_id)
+        self.session.close()
+
+    async def send_json(self, data: Dict[str, Any], request_id: Optional[str] = None):
+        if request_id is not None:
+            data = {**data, "request_id": request_id}
+        await self.send_encoded(self.codec.encode(data))
+
+    async def send_encoded(self, payload):
+        WS_FRAME_BYTES.labels("send").observe(len(payload))
+        # Concurrent requests share the socket; keep each frame's write whole
+        async with self._send_lock:
+            await self.codec.send(self.websocket, payload)
+
+    async def _dispatch(self, data: Dict[str, Any]):
+        request_id = data.get("request_id")
+        if request_id is not None:
+            request_id = str(request_id)
+        if data.get("type") == "cancel":
+            await self._cancel(request_id)
+            return
+
+        handler = self._handler_for(data)
+        if handler is None:
+            await self.send_json({"type": "error", "error": "Unknown request"}, request_id)
+            return
+        if request_id is not None and request_id in self._requests:
+            await self.send_json({"type": "error", "error": f"Request {request_id} is already in flight"}, request_id)
+            return
+        if len(self._tasks) >= self.config.CONNECTION_MAX_PENDING_REQUESTS:
+            await self.send_json({"type": "error", "error": "Too many requests pending"}, request_id)
+            return
+
+        previous = self._untagged if request_id is None else None
+        task = asyncio.create_task(self._handle(handler, data, request_id, previous))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if request_id is not None:
+            self._requests[request_id] = task
+            task.add_done_callback(lambda _: self._requests.pop(request_id, None))
+        else:
+            self._untagged = task
+
+    def _handler_for(self, data: Dict[str, Any]) -> Optional[Callable[[Dict[str, Any], RequestChannel], Awaitable[None]]]:
+        if 'public_key' in data:
+            return self._init
+        if data.get('type') == 'get_thread_messages':
+            return self._get_thread_messages
+        if 'prompt' in data:
+            return self._prompt
+        if data.get('type') == 'get_related_threads':
+            return self._get_related_threads
+        if data.get('type') == 'create_thread':
+            return self._create_thread
+        if data.get('type') == 'watch_thread':
+            return self._watch_thread
+        if data.get('type') == 'unwatch_thread':
+            return self._unwatch_thread
+        return None
+
+    async def _handle(self, handler, data: Dict[str, Any], request_id: Optional[str], previous: Optional[asyncio.Task] = None):
+        channel = RequestChannel(self, request_id)
+        try:
+            if previous is not None:
+                # asyncio.wait returns however `previous` ended, failed or cancelled
+                await asyncio.wait([previous])
+            async with self._slots:
+                WS_REQUESTS_IN_FLIGHT.inc()
+                try:
+                    await handler(data, channel)
+                finally:
+                    WS_REQUESTS_IN_FLIGHT.dec()
+        except asyncio.CancelledError:
+            logger.info(f"Request {request_id} cancelled")
+            if request_id is not None and self.websocket.client_state == WebSocketState.CONNECTED:
+                with suppress(Exception):
+                    await channel.send_json({"type": "cancelled"})
+        except Exception as e:
+            logger.error(f"Error handling request {request_id}: {str(e)}")
+            if self.websocket.client_state == WebSocketState.CONNECTED:
+                with suppress(Exception):
+                    await channel.send_json({"type": "error", "error": str(e)})
+
+    async def _cancel(self, request_id: Optional[str]):
+        task = self._requests.get(request_id) if request_id is not None else None
+        if task is None:
+            await self.send_json({"type": "error", "error": f"No request {request_id} in flight"}, request_id)
+            return
+        # The request's own task answers with a "cancelled" frame once it has stopped
+        task.cancel()
+
+    async def _init(self, data: Dict[str, Any], channel: RequestChannel):
+        public_key = data['public_key']
+        user = await self.db_client.get_user(public_key)
+        if not user:
+            user = await self.db_client.create_user(public_key)
+        chat_threads = await self.db_client.get_chat_threads(user.id)
+        logger.info(f"Sending init message with {len(chat_threads)} chat_threads")
+        # Models are encoded in place by the codec
+        await channel.send_json({
+            "type": "init",
+            "user": user,
+            "chat_threads": chat_threads
+        })
+
+    async def _get_thread_messages(self, data: Dict[str, Any], channel: RequestChannel):
+        thread_id = data['thread_id']
+        before = int(data['before']) if data.get('before') is not None else None
+        before_id = str(data['before_id']) if before is not None and data.get('before_id') is not None else None
+        limit = min(int(data.get('limit') or self.config.THREAD_PAGE_SIZE), self.config.THREAD_PAGE_MAX)
+        logger.info(f"Received 'get_thread_messages' request for thread {thread_id} (before={before}, limit={limit})")
+        await self._watch(thread_id)
+        if before is None:
+            # Read enough of the newest page to also prime the session cache for prompts
+            fetch_limit = max(limit, self.config.CONTEXT_HISTORY_LIMIT)
+            fetched = await self.db_client.get_messages_for_thread(thread_id, limit=fetch_limit)
+            self.session.prime(thread_id, fetched)
+            messages = fetched[-limit:]
+            has_more = len(fetched) > limit or len(fetched) == fetch_limit
+        else:
+            messages = await self.db_client.get_messages_for_thread(thread_id, before=before, limit=limit, before_id=before_id)
+            has_more = len(messages) == limit
+        logger.info(f"Retrieved {len(messages)} messages for thread {thread_id}")
+        await channel.send_json({
+            'type': 'thread_messages',
+            'thread_id': thread_id,
+            'messages': messages,
+            'before': before,
+            'before_id': before_id,
+            # (next_before, next_before_id) is the cursor for the next page; seq alone can tie across workers
+            'next_before': messages[0].seq if has_more and messages else None,
+            'next_before_id': messages[0].id if has_more and messages else None,
+            'has_more': has_more
+        })
+
+    async def _prompt(self, data: Dict[str, Any], channel: RequestChannel):
+        user_prompt = data['prompt']
+        thread_id = data['thread_id']
+        await self._watch(thread_id)
+        chat_history, thread = await asyncio.gather(
+            self.session.history(thread_id),
+            self.db_client.get_chat_thread(thread_id)
+        )
+        await self.chorus.run(user_prompt, channel, chat_history, thread_id, thread=thread, session=self.session, origin=self.id)
+
+    async def _get_related_threads(self, data: Dict[str, Any], channel: RequestChannel):
+        thread_id = data['thread_id']
+        limit = min(int(data.get('limit') or self.config.RELATED_THREADS_LIMIT), self.config.THREAD_PAGE_MAX)
+        related = await self.db_client.get_related_threads(thread_id, limit)
+        await channel.send_json({
+            'type': 'related_threads',
+            'thread_id': thread_id,
+            'chat_threads': related
+        })
+
+    async def _create_thread(self, data: Dict[str, Any], channel: RequestChannel):
+        user_id = data['user_id']
+        name = data['name']
+        logger.info(f"Received request to create new thread for user {user_id} with name {name}")
+        thread = await self.db_client.create_chat_thread(user_id, name)
+        await channel.send_json({
+            'type': 'new_thread',
+            'chat_thread': thread
+        })
+
+    async def _watch_thread(self, data: Dict[str, Any], channel: RequestChannel):
+        await self._watch(data['thread_id'])
+        await channel.send_json({'type': 'watching', 'thread_id': data['thread_id']})
+
+    async def _unwatch_thread(self, data: Dict[str, Any], channel: RequestChannel):
+        await self._unwatch(data['thread_id'])
+        await channel.send_json({'type': 'unwatched', 'thread_id': data['thread_id']})
+
+    async def _watch(self, thread_id: str):
+        if thread_id in self._watches:
+            self._watches.move_to_end(thread_id)
+            return
+        subscription = await self.pubsub.subscribe(thread_channel(thread_id))
+        self._watches[thread_id] = (subscription, asyncio.create_task(self._relay(subscription)))
+        while len(self._watches) > self.config.CONNECTION_MAX_WATCHED_THREADS:
+            await self._unwatch(next(iter(self._watches)))
+
+    async def _unwatch(self, thread_id: str):
+        watch = self._watches.pop(thread_id, None)
+        if watch is None:
+            return
+        subscription, relay = watch
+        relay.cancel()
+        with suppress(asyncio.CancelledError):
+            await relay
+        await subscription.close()
+
+    async def _relay(self, subscription: Subscription):
+        async for event in subscription:
+            if event.get("origin") == self.id:
+                continue
+            try:
+                # Every local watcher sends the same bytes, so the frame is encoded once per event
+                if event.get("type") == "thread_message":
+                    # Also keeps this connection's cached history current across workers
+                    self.session.apply(Message(**event["message"]))
+                    frame = {"type": "thread_message", "thread_id": event["thread_id"], "message": event["message"]}
+                    await self.send_encoded(self.codec.encode_shared(event, frame))
+                elif event.get("type") == "thread_step":
+                    frame = {"type": "thread_step", "thread_id": event["thread_id"], "result": event["result"]}
+                    await self.send_encoded(self.codec.encode_shared(event, frame))
+            except Exception as e:
+                logger.error(f"Error relaying {event.get('type')} event for {subscription.channel}: {e}")
@@ -0,0 +1,78 @@
+from typing import Iterator, List, Dict, Optional, Tuple
+import tiktoken
+from config import Config
+from models import Message
+from utils import logger, chat_completion
+
+# Chat models served through Azure deployments have no tiktoken mapping; cl100k_base is close enough for budgeting
+_encoding = tiktoken.get_encoding("cl100k_base")
+
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def count_tokens(text: str) -> int:
+    return len(_encoding.encode(text or "", disallowed_special=()))
+
+class ContextWindow:
+    """
+    Token-budgeted view of a thread's history for the Chorus loop: the most recent
+    messages that fit in CONTEXT_TOKEN_BUDGET, preceded by the thread's rolling
+    summary of everything older.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+
+    def split(self, history: List[Message]) -> Tuple[List[Message], List[Message]]:
+        """Split history (oldest first) into (older, recent) where recent fits the budget."""
+        budget = self.config.CONTEXT_TOKEN_BUDGET
+        used = 0
+        cut = len(history)
+        for index in range(len(history) - 1, -1, -1):
+            used += count_tokens(history[index].content) + MESSAGE_OVERHEAD_TOKENS
+            if used > budget:
+                break
+            cut = index
+        return history[:cut], history[cut:]
+
+    def build(self, recent: List[Message], summary: Optional[str]) -> List[Dict[str, str]]:
+        messages = []
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation in this thread:\n{summary}"})
+        messages.extend({"role": message.role, "content": message.content} for message in recent)
+        return messages
+
+    def batches(self, messages: List[Message]) -> Iterator[List[Message]]:
+        """Consecutive runs of `messages` of at most CONTEXT_TOKEN_BUDGET tokens each, to summarize one at a time."""
+        batch: List[Message] = []
+        used = 0
+        for message in messages:
+            tokens = count_tokens(message.content) + MESSAGE_OVERHEAD_TOKENS
+            if batch and used + tokens > self.config.CONTEXT_TOKEN_BUDGET:
+                yield batch
+                batch, used = [], 0
+            batch.append(message)
+            used += tokens
+        if batch:
+            yield batch
+
+    async def summarize(self, summary: Optional[str], older: List[Message]) -> Optional[str]:
+        """Fold messages that fell out of the window into the rolling summary; None if that failed."""
+        transcript = "\n".join(f"{message.role}: {message.content}" for message in older)
+        summary_prompt = """
+        Update the running summary of this conversation with the new messages below.
+        Keep the facts, decisions and open questions a participant would need to continue the conversation.
+        Return only the updated summary.
+        """
+        result = await chat_completion(
+            messages=[
+                {"role": "system", "content": summary_prompt},
+                {"role": "user", "content": f"Current summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"}
+            ],
+            model=self.config.CHAT_MODEL,
+            max_tokens=self.config.SUMMARY_MAX_TOKENS,
+            temperature=0
+        )
+        if result == "error":
+            logger.error("Failed to update rolling summary; keeping the previous one")
+            return None
+        return result
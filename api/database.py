@@ -1,31 +1,92 @@
-from qdrant_client import QdrantClient, models
+from qdrant_client import AsyncQdrantClient, models
 from qdrant_client.http.exceptions import ApiException, UnexpectedResponse
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Set, Tuple
 from datetime import datetime
 import uuid
+import httpx
+import numpy as np
 from config import Config
 from utils import logger
-import json
-from models import User, ChatThread, Message
-from itertools import groupby
-from operator import itemgetter
+from models import User, ChatThread, Message, SearchFilter, CorpusChunk
+from backend import StorageBackend, next_sequence, running_mean
+from metrics import instrument_backend
+from locks import create_keyed_lock
+
+# Optional named vector on users and chat_threads; points without one are payload-only
+CENTROID_VECTOR = "centroid"
+
+# Payload projections: reads fetch only the fields they turn into models
+USER_FIELDS = ["id", "public_key", "created_at", "centroid_count", "chat_threads"]
+CHAT_THREAD_FIELDS = ["id", "user_id", "name", "created_at", "summary", "summary_seq", "centroid_count"]
+MESSAGE_FIELDS = ["id", "thread_id", "user_id", "role", "content", "created_at", "step", "seq", "token_value"]
+SEARCH_FIELDS = ["thread_id", "content", "created_at", "role", "token_value", "step"]
+
+def centroid_operations(point_id, centroid: List[float], count: int) -> List[models.UpdateOperation]:
+    """
+    Write a centroid and its message count. Qdrant normalizes cosine vectors on
+    write, so the mean's norm is kept in the payload to recover the running mean.
+    """
+    return [
+        models.UpdateVectorsOperation(
+            update_vectors=models.UpdateVectors(
+                points=[models.PointVectors(id=point_id, vector={CENTROID_VECTOR: centroid})]
+            )
+        ),
+        models.SetPayloadOperation(
+            set_payload=models.SetPayload(
+                payload={"centroid_count": count, "centroid_norm": float(np.linalg.norm(centroid))},
+                points=[point_id]
+            )
+        ),
+    ]
 
-class DatabaseClient:
+@instrument_backend
+class DatabaseClient(StorageBackend):
     def __init__(self, config: Config):
         self.config = config
-        self.client = QdrantClient(url=config.QDRANT_URL, api_key=config.QDRANT_API_KEY)
-
-    def generate_unique_id(self) -> str:
-        return str(uuid.uuid4())
-
-    async def search(self, query_embedding: List[float]) -> List[Dict[str, Any]]:
+        self.client = AsyncQdrantClient(
+            url=config.QDRANT_URL,
+            api_key=config.QDRANT_API_KEY or None,
+            prefer_grpc=config.QDRANT_PREFER_GRPC,
+            grpc_port=config.QDRANT_GRPC_PORT,
+            timeout=config.QDRANT_TIMEOUT,
+            # REST transport: one pooled httpx client with keep-alive connections
+            limits=httpx.Limits(
+                max_connections=config.QDRANT_MAX_CONNECTIONS,
+                max_keepalive_connections=config.QDRANT_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=config.QDRANT_KEEPALIVE_EXPIRY,
+            ),
+            # gRPC transport: a single multiplexed HTTP/2 channel kept alive with pings
+            grpc_options={
+                "grpc.keepalive_time_ms": int(config.QDRANT_KEEPALIVE_EXPIRY * 1000),
+                "grpc.keepalive_permit_without_calls": 1,
+            },
+        )
+        # Serializes centroid read-modify-writes per owner, across workers when they share Redis
+        self._centroid_locks = create_keyed_lock(config)
+
+    async def close(self) -> None:
+        await self.client.close()
+        await self._centroid_locks.close()
+
+    async def search(self, query_embedding: List[float], with_vectors: bool = False, filters: Optional[SearchFilter] = None) -> List[Dict[str, Any]]:
+        """
+        Nearest messages to the query embedding, best first. `filters` narrows the
+        search through the payload indexes. With `with_vectors`, each hit also
+        carries its stored vector for downstream reranking.
+        """
         try:
-            logger.info(f"Searching with query embedding of length {len(query_embedding)}, limit={self.config.SEARCH_LIMIT}")
-            results = self.client.search(
+            logger.info(f"Searching with query embedding of length {len(query_embedding)}, limit={self.config.SEARCH_LIMIT}, filters={filters}")
+            response = await self.client.query_points(
                 collection_name=self.config.MESSAGES_COLLECTION,
-                query_vector=query_embedding,
-                limit=self.config.SEARCH_LIMIT
+                query=query_embedding,
+                query_filter=self._search_filter(filters),
+                search_params=self._search_params(),
+                limit=self.config.SEARCH_LIMIT,
+                with_payload=SEARCH_FIELDS,
+                with_vectors=with_vectors
             )
+            results = response.points
             logger.info(f"Search returned {len(results)} results")
 
             search_results = []
@@ -41,37 +102,50 @@ class DatabaseClient:
                         "step": result.payload.get('step', ''),
                         "similarity": result.score
                     }
+                    if with_vectors:
+                        search_result["vector"] = result.vector
                     search_results.append(search_result)
                 except Exception as e:
                     logger.error(f"Error processing search result: {e}")
                     continue
 
             logger.info(f"Processed {len(search_results)} search results")
-
-            # Deduplicate search results
-            deduplicated_results = self._deduplicate_search_results(search_results)
-            logger.info(f"Deduplicated to {len(deduplicated_results)} results")
-
-            return deduplicated_results
+            return search_results
         except Exception as e:
             logger.error(f"Error during search operation: {e}")
             return []
 
-    def _deduplicate_search_results(self, search_results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        # Sort the results by content and created_at
-        sorted_results = sorted(search_results, key=lambda x: (x['content'], x['created_at']))
-
-        # Group by content
-        grouped = groupby(sorted_results, key=itemgetter('content'))
-
-        # Keep the earliest result for each unique content
-        deduplicated = [next(group) for _, group in grouped]
+    def _search_params(self) -> Optional[models.SearchParams]:
+        if self.config.MESSAGES_QUANTIZATION == "none":
+            return None
+        # Search the quantized index, then rescore the oversampled candidates with the originals
+        return models.SearchParams(
+            quantization=models.QuantizationSearchParams(
+                rescore=self.config.SEARCH_RESCORE,
+                oversampling=self.config.SEARCH_OVERSAMPLING
+            )
+        )
 
-        return deduplicated
+    def _search_filter(self, filters: Optional[SearchFilter]) -> Optional[models.Filter]:
+        if filters is None:
+            return None
+        conditions = []
+        if filters.thread_ids is not None:
+            conditions.append(models.FieldCondition(key="thread_id", match=models.MatchAny(any=filters.thread_ids)))
+        for key in ("user_id", "role", "step"):
+            value = getattr(filters, key)
+            if value is not None:
+                conditions.append(models.FieldCondition(key=key, match=models.MatchValue(value=value)))
+        if filters.created_after is not None or filters.created_before is not None:
+            conditions.append(models.FieldCondition(
+                key="created_at",
+                range=models.DatetimeRange(gte=filters.created_after, lte=filters.created_before)
+            ))
+        return models.Filter(must=conditions) if conditions else None
 
     async def upsert(self, content: str, embedding: List[float], is_human_generated: bool) -> None:
         try:
-            self.client.upsert(
+            await self.client.upsert(
                 collection_name=self.config.MESSAGES_COLLECTION,
                 points=[
                     models.PointStruct(
@@ -90,24 +164,48 @@ class DatabaseClient:
         except (ApiException, UnexpectedResponse) as e:
             logger.error(f"Error during upsert operation: {e}")
 
+    async def bulk_upsert(self, chunks: List[CorpusChunk]) -> None:
+        if not chunks:
+            return
+        try:
+            await self.client.upsert(
+                collection_name=self.config.MESSAGES_COLLECTION,
+                points=[
+                    models.PointStruct(id=chunk.id, vector=chunk.vector, payload=chunk.dict())
+                    for chunk in chunks
+                ]
+            )
+        except Exception as e:
+            logger.error(f"Error bulk upserting {len(chunks)} chunks: {e}")
+            raise
+
+    async def existing_ids(self, ids: List[str]) -> Set[str]:
+        if not ids:
+            return set()
+        points = await self.client.retrieve(
+            collection_name=self.config.MESSAGES_COLLECTION,
+            ids=ids,
+            with_payload=False,
+            with_vectors=False
+        )
+        return {str(point.id) for point in points}
+
     # New methods for 'users' collection
     async def create_user(self, public_key: str) -> User:
         user_id = self.generate_unique_id()
-        default_vector = [0.0] * 1536  # Adjust dimension if needed
         user = User(
             id=user_id,
             public_key=public_key,
             created_at=datetime.utcnow().isoformat(),
-            vector=default_vector,
             chat_threads=[]  # Initialize as an empty list
         )
         try:
-            self.client.upsert(
+            await self.client.upsert(
                 collection_name=self.config.USERS_COLLECTION,
                 points=[
                     models.PointStruct(
                         id=user.id,
-                        vector=user.vector,
+                        vector={},  # Payload-only until a centroid is computed
                         payload=user.dict(exclude={'vector'})
                     )
                 ]
@@ -119,7 +217,7 @@ class DatabaseClient:
 
     async def get_user(self, public_key: str) -> Optional[User]:
         try:
-            scroll_result = self.client.scroll(
+            scroll_result = await self.client.scroll(
                 collection_name=self.config.USERS_COLLECTION,
                 scroll_filter=models.Filter(
                     must=[
@@ -129,7 +227,9 @@ class DatabaseClient:
                         )
                     ]
                 ),
-                limit=1  # We only need one user
+                limit=1,  # We only need one user
+                with_payload=USER_FIELDS,
+                with_vectors=False
             )
             users, _ = scroll_result
             if users:
@@ -144,9 +244,11 @@ class DatabaseClient:
             logger.info(f"Retrieving chat threads for user {user_id}")
 
             # Retrieve the user to get their chat thread IDs
-            user_records = self.client.retrieve(
+            user_records = await self.client.retrieve(
                 collection_name=self.config.USERS_COLLECTION,
-                ids=[user_id]
+                ids=[user_id],
+                with_payload=["chat_threads"],
+                with_vectors=False
             )
 
             if not user_records:
@@ -161,9 +263,11 @@ class DatabaseClient:
                 return []
 
             # Retrieve the chat threads using the thread IDs
-            thread_records = self.client.retrieve(
+            thread_records = await self.client.retrieve(
                 collection_name=self.config.CHAT_THREADS_COLLECTION,
-                ids=thread_ids
+                ids=thread_ids,
+                with_payload=CHAT_THREAD_FIELDS,
+                with_vectors=False
             )
 
             chat_threads = [ChatThread(**thread.payload) for thread in thread_records]
@@ -175,32 +279,32 @@ class DatabaseClient:
 
     async def create_chat_thread(self, user_id: str, name: str) -> ChatThread:
         thread_id = self.generate_unique_id()
-        default_vector = [0.0] * 1536  # Adjust dimension if needed
         thread = ChatThread(
             id=thread_id,
             user_id=user_id,
             name=name,
             created_at=datetime.utcnow().isoformat(),
-            vector=default_vector,
             messages=[]
         )
         try:
             # Upsert the new chat thread
-            self.client.upsert(
+            await self.client.upsert(
                 collection_name=self.config.CHAT_THREADS_COLLECTION,
                 points=[
                     models.PointStruct(
                         id=thread.id,
-                        vector=thread.vector,
-                        payload=thread.dict(exclude={'vector'})
+                        vector={},  # Payload-only until a centroid is computed
+                        payload=thread.dict(exclude={'vector', 'messages'})
                     )
                 ]
             )
 
             # Retrieve the existing user payload
-            user_points = self.client.retrieve(
+            user_points = await self.client.retrieve(
                 collection_name=self.config.USERS_COLLECTION,
-                ids=[user_id]
+                ids=[user_id],
+                with_payload=["chat_threads"],
+                with_vectors=False
             )
 
             if not user_points:
@@ -212,7 +316,7 @@ class DatabaseClient:
             chat_threads.append(thread_id)
 
             # Update the user's payload with the new chat_threads list
-            self.client.set_payload(
+            await self.client.set_payload(
                 collection_name=self.config.USERS_COLLECTION,
                 payload={"chat_threads": chat_threads},
                 points=[user_id]
@@ -224,11 +328,20 @@ class DatabaseClient:
             logger.error(f"Error creating chat thread: {e}")
             raise
 
-    async def save_message(self, message: Message):
+    async def save_messages(self, messages: List[Message]):
+        """
+        Upsert a batch of messages in one request. Thread membership is the
+        message's own thread_id and seq payload, so appending never touches the
+        thread point and concurrent writers cannot lose each other's messages.
+        """
+        if not messages:
+            return
         try:
-            logger.info(f"Saving message {message.id} to thread {message.thread_id}")
-            # First, upsert the message into the messages collection
-            self.client.upsert(
+            logger.info(f"Saving {len(messages)} messages")
+            for message in messages:
+                if message.seq is None:
+                    message.seq = next_sequence()
+            await self.client.upsert(
                 collection_name=self.config.MESSAGES_COLLECTION,
                 points=[
                     models.PointStruct(
@@ -236,62 +349,227 @@ class DatabaseClient:
                         vector=message.vector,
                         payload=message.dict(exclude={"vector"})
                     )
+                    for message in messages
                 ]
             )
+            logger.info(f"Successfully saved {len(messages)} messages")
+        except Exception as e:
+            logger.error(f"Error saving messages: {e}")
+            raise
+        await self._update_centroids(messages)
+
+    async def _update_centroids(self, messages: List[Message]):
+        """
+        Fold the batch's embeddings into the running-mean centroids of their
+        threads and users. Best effort: the messages are already stored, so a
+        failure here only leaves a centroid slightly stale.
+        """
+        for collection_name, key in (
+            (self.config.CHAT_THREADS_COLLECTION, "thread_id"),
+            (self.config.USERS_COLLECTION, "user_id"),
+        ):
+            groups: Dict[str, List[List[float]]] = {}
+            for message in messages:
+                owner = getattr(message, key)
+                if owner and message.vector:
+                    groups.setdefault(owner, []).append(message.vector)
+            if not groups:
+                continue
+            try:
+                async with self._centroid_locks.hold(f"{collection_name}:{owner}" for owner in groups):
+                    records = await self.client.retrieve(
+                        collection_name=collection_name,
+                        ids=list(groups),
+                        with_payload=["centroid_count", "centroid_norm"],
+                        with_vectors=[CENTROID_VECTOR]
+                    )
+                    operations = []
+                    for record in records:
+                        stored = (record.vector or {}).get(CENTROID_VECTOR)
+                        # Cosine collections store unit vectors; the norm payload restores the mean
+                        centroid, count = running_mean(
+                            (np.asarray(stored) * record.payload.get("centroid_norm", 1.0)).tolist() if stored else None,
+                            record.payload.get("centroid_count", 0),
+                            groups[str(record.id)]
+                        )
+                        operations.extend(centroid_operations(record.id, centroid, count))
+                    if operations:
+                        await self.client.batch_update_points(collection_name=collection_name, update_operations=operations)
+            except Exception as e:
+                logger.error(f"Error updating centroids in {collection_name}: {e}")
 
-            # Retrieve the existing thread payload
-            thread_records = self.client.retrieve(
+    async def search_threads(self, query_embedding: List[float], limit: int, user_id: Optional[str] = None, exclude: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        try:
+            conditions = []
+            if user_id is not None:
+                conditions.append(models.FieldCondition(key="user_id", match=models.MatchValue(value=user_id)))
+            response = await self.client.query_points(
                 collection_name=self.config.CHAT_THREADS_COLLECTION,
-                ids=[message.thread_id]
+                query=query_embedding,
+                using=CENTROID_VECTOR,
+                query_filter=models.Filter(
+                    must=conditions,
+                    must_not=[models.HasIdCondition(has_id=exclude)] if exclude else None
+                ),
+                limit=limit,
+                with_payload=False,
+                with_vectors=False
             )
+            return [{"id": str(point.id), "similarity": point.score} for point in response.points]
+        except Exception as e:
+            logger.error(f"Error searching thread centroids: {e}")
+            return []
 
-            if not thread_records:
-                logger.error(f"Thread not found: {message.thread_id}")
-                raise Exception(f"Thread not found: {message.thread_id}")
-
-            thread_payload = thread_records[0].payload
-            messages_list = thread_payload.get('messages', [])
-            messages_list.append(message.id)
-
-            # Update the thread's payload with the new messages list
-            self.client.set_payload(
+    async def get_thread_centroid(self, thread_id: str) -> Tuple[Optional[ChatThread], Optional[List[float]]]:
+        try:
+            records = await self.client.retrieve(
                 collection_name=self.config.CHAT_THREADS_COLLECTION,
-                payload={"messages": messages_list},
-                points=[message.thread_id]
+                ids=[thread_id],
+                with_payload=CHAT_THREAD_FIELDS,
+                with_vectors=[CENTROID_VECTOR]
             )
-
-            logger.info(f"Successfully saved message: {message.id} to thread: {message.thread_id}")
+            if not records:
+                return None, None
+            return ChatThread(**records[0].payload), (records[0].vector or {}).get(CENTROID_VECTOR)
         except Exception as e:
-            logger.error(f"Error saving message: {e}")
-            raise
+            logger.error(f"Error getting centroid for thread {thread_id}: {e}")
+            return None, None
+
+    async def get_messages_for_thread(self, thread_id: str, before: Optional[int] = None, limit: Optional[int] = None, before_id: Optional[str] = None) -> List[Message]:
+        """
+        Messages of a thread in (seq, id) order. With `limit`, returns only the
+        newest `limit` messages before the (before, before_id) cursor; pass the
+        first returned message's seq and id as the next cursor to page further
+        back. Without `limit`, returns the whole history up to the cursor.
+
+        Qdrant orders by seq alone, so wherever a limited scroll stops inside a
+        run of equal seqs the whole run is fetched and ordered by id; otherwise
+        messages sharing a seq could fall between pages.
+        """
+        try:
+            logger.info(f"Retrieving messages for thread {thread_id} (before={before}, before_id={before_id}, limit={limit})")
+            if limit is not None:
+                messages: List[Message] = []
+                if before is not None and before_id is not None:
+                    messages = [message for message in await self._messages_at_seq(thread_id, before) if message.id < before_id]
+                points, _ = await self.client.scroll(
+                    collection_name=self.config.MESSAGES_COLLECTION,
+                    scroll_filter=self._thread_messages_filter(thread_id, lt=before),
+                    order_by=models.OrderBy(key="seq", direction=models.Direction.DESC),
+                    limit=limit,
+                    with_payload=MESSAGE_FIELDS,
+                    with_vectors=False
+                )
+                page = [Message(**point.payload) for point in points]
+                if len(page) == limit:
+                    boundary = page[-1].seq
+                    page = [message for message in page if message.seq != boundary] + await self._messages_at_seq(thread_id, boundary)
+                messages = sorted(messages + page, key=lambda message: (message.seq, message.id))[-limit:]
+                logger.info(f"Retrieved {len(messages)} messages for thread {thread_id}")
+                return messages
+
+            page_size = self.config.MESSAGES_PAGE_SIZE
+            messages = []
+            if before is not None and before_id is not None:
+                tail = [message for message in await self._messages_at_seq(thread_id, before) if message.id < before_id]
+            else:
+                tail = []
+            last_seq: Optional[int] = None
+            while True:
+                # Ordered scrolls do not return an offset, so page on the seq range instead
+                points, _ = await self.client.scroll(
+                    collection_name=self.config.MESSAGES_COLLECTION,
+                    scroll_filter=self._thread_messages_filter(thread_id, gt=last_seq, lt=before),
+                    order_by=models.OrderBy(key="seq", direction=models.Direction.ASC),
+                    limit=page_size,
+                    with_payload=MESSAGE_FIELDS,
+                    with_vectors=False
+                )
+                page = [Message(**point.payload) for point in points]
+                if len(page) < page_size:
+                    messages.extend(page)
+                    break
+                # Take the whole run at the page's last seq so the next page can start strictly after it
+                last_seq = page[-1].seq
+                messages.extend(message for message in page if message.seq != last_seq)
+                messages.extend(await self._messages_at_seq(thread_id, last_seq))
+            messages.sort(key=lambda message: (message.seq, message.id))
+            messages.extend(tail)
+
+            logger.info(f"Retrieved {len(messages)} messages for thread {thread_id}")
+            return messages
+        except Exception as e:
+            logger.error(f"Error getting messages for thread {thread_id}: {e}")
+            return []
 
-    async def get_messages_for_thread(self, thread_id: str) -> List[Message]:
+    async def get_thread_head(self, thread_id: str) -> Optional[Tuple[int, str]]:
+        """One ordered limit-1 scroll of the seq alone; cheap enough to run before every cached read."""
         try:
-            logger.info(f"Retrieving messages for thread {thread_id}")
-            thread_records = self.client.retrieve(
-                collection_name=self.config.CHAT_THREADS_COLLECTION,
-                ids=[thread_id]
+            points, _ = await self.client.scroll(
+                collection_name=self.config.MESSAGES_COLLECTION,
+                scroll_filter=self._thread_messages_filter(thread_id),
+                order_by=models.OrderBy(key="seq", direction=models.Direction.DESC),
+                limit=1,
+                with_payload=["seq"],
+                with_vectors=False
             )
+            if not points:
+                return None
+            return points[0].payload.get("seq"), str(points[0].id)
+        except Exception as e:
+            logger.error(f"Error getting head of thread {thread_id}: {e}")
+            return None
 
-            if not thread_records:
-                logger.error(f"Thread not found: {thread_id}")
-                return []
-
-            thread_payload = thread_records[0].payload
-            message_ids = thread_payload.get('messages', [])
-            logger.info(f"Found message IDs: {message_ids}")
-
-            if not message_ids:
-                logger.info(f"No messages in thread {thread_id}")
-                return []
-
-            messages = self.client.retrieve(
+    async def _messages_at_seq(self, thread_id: str, seq: int) -> List[Message]:
+        """Every message of the thread with exactly this seq, ordered by id."""
+        messages: List[Message] = []
+        offset = None
+        while True:
+            points, offset = await self.client.scroll(
                 collection_name=self.config.MESSAGES_COLLECTION,
-                ids=message_ids
+                scroll_filter=self._thread_messages_filter(thread_id, gte=seq, lte=seq),
+                limit=self.config.MESSAGES_PAGE_SIZE,
+                offset=offset,
+                with_payload=MESSAGE_FIELDS,
+                with_vectors=False
             )
+            messages.extend(Message(**point.payload) for point in points)
+            if offset is None:
+                return sorted(messages, key=lambda message: message.id)
+
+    def _thread_messages_filter(self, thread_id: str, gt: Optional[int] = None, lt: Optional[int] = None, gte: Optional[int] = None, lte: Optional[int] = None) -> models.Filter:
+        conditions = [
+            models.FieldCondition(key="thread_id", match=models.MatchValue(value=thread_id))
+        ]
+        if any(bound is not None for bound in (gt, lt, gte, lte)):
+            conditions.append(models.FieldCondition(key="seq", range=models.Range(gt=gt, lt=lt, gte=gte, lte=lte)))
+        return models.Filter(must=conditions)
+
+    async def get_chat_thread(self, thread_id: str) -> Optional[ChatThread]:
+        try:
+            thread_records = await self.client.retrieve(
+                collection_name=self.config.CHAT_THREADS_COLLECTION,
+                ids=[thread_id],
+                with_payload=CHAT_THREAD_FIELDS,
+                with_vectors=False
+            )
+            if thread_records:
+                return ChatThread(**thread_records[0].payload)
+            return None
+        except Exception as e:
+            logger.error(f"Error getting chat thread {thread_id}: {e}")
+            return None
 
-            logger.info(f"Retrieved {len(messages)} messages from collection")
-            return [Message(**msg.payload) for msg in messages]
+    async def update_thread_summary(self, thread_id: str, summary: str, summary_seq: int):
+        try:
+            thread = await self.get_chat_thread(thread_id)
+            if thread is None or (thread.summary_seq is not None and thread.summary_seq >= summary_seq):
+                logger.info(f"Skipping stale summary for thread {thread_id} (seq {summary_seq})")
+                return
+            await self.client.set_payload(
+                collection_name=self.config.CHAT_THREADS_COLLECTION,
+                payload={"summary": summary, "summary_seq": summary_seq},
+                points=[thread_id]
+            )
         except Exception as e:
-            logger.error(f"Error getting messages for thread {thread_id}: {e}")
-            return []
+            logger.error(f"Error updating summary for thread {thread_id}: {e}")
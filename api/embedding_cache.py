@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_text(text: str) -> str:
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+def cache_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache keyed by (model, hash of normalized text).
+    A bounded in-memory LRU sits in front of an optional SQLite tier that survives
+    restarts. Vectors are held as float32 in both tiers. Misses already being
+    embedded by another caller are tracked too, so concurrent requests for the
+    same text share one upstream call.
+    """
+
+    def __init__(self, max_entries: int, path: str = ""):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self._db.commit()
+
+    async def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        missing: List[str] = []
+        for key in keys:
+            vector = self._entries.get(key)
+            if vector is None:
+                missing.append(key)
+                continue
+            self._entries.move_to_end(key)
+            self.memory_hits += 1
+            found[key] = vector.tolist()
+
+        if missing and self._db is not None:
+            try:
+                rows = await asyncio.to_thread(self._read_disk, missing)
+            except sqlite3.Error as e:
+                logger.error(f"Error reading embedding cache: {e}")
+                rows = {}
+            for key, vector in rows.items():
+                self._remember(key, vector)
+                self.disk_hits += 1
+                found[key] = vector.tolist()
+
+            missing = [key for key in missing if key not in rows]
+
+        self.misses += len(missing)
+        return found
+
+    async def put_many(self, vectors: Dict[str, List[float]]) -> None:
+        arrays = {key: np.asarray(vector, dtype=np.float32) for key, vector in vectors.items() if vector}
+        for key, vector in arrays.items():
+            self._remember(key, vector)
+        if arrays and self._db is not None:
+            try:
+                await asyncio.to_thread(self._write_disk, arrays)
+            except sqlite3.Error as e:
+                logger.error(f"Error writing embedding cache: {e}")
+
+    def claim(self, keys: Iterable[str]) -> Tuple[List[str], Dict[str, asyncio.Future]]:
+        """
+        Split missed keys into those this caller must embed, now marked in
+        flight, and those another caller is already embedding, with the future
+        that will carry each vector.
+        """
+        loop = asyncio.get_running_loop()
+        owned: List[str] = []
+        waiting: Dict[str, asyncio.Future] = {}
+        for key in keys:
+            future = self._inflight.get(key)
+            if future is None:
+                self._inflight[key] = loop.create_future()
+                owned.append(key)
+            else:
+                waiting[key] = future
+        self.coalesced += len(waiting)
+        return owned, waiting
+
+    def release(self, keys: Iterable[str], vectors: Optional[Dict[str, List[float]]] = None) -> None:
+        """Hand claimed keys' vectors to their waiters; without `vectors` the waiters embed them themselves."""
+        for key in keys:
+            future = self._inflight.pop(key, None)
+            if future is None or future.done():
+                continue
+            if vectors is None:
+                future.cancel()
+            else:
+                future.set_result(vectors.get(key, []))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _read_disk(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        rows = []
+        with self._db_lock:
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" for _ in batch)
+                rows.extend(self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall())
+        return {key: np.frombuffer(blob, dtype=np.float32).copy() for key, blob in rows}
+
+    def _write_disk(self, vectors: Dict[str, np.ndarray]) -> None:
+        with self._db_lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, vector.tobytes()) for key, vector in vectors.items()]
+            )
+            self._db.commit()
+
+_embedding_cache: Optional[EmbeddingCache] = None
+
+def get_embedding_cache(config: Config) -> EmbeddingCache:
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache(config.EMBEDDING_CACHE_SIZE, config.EMBEDDING_CACHE_PATH)
+    return _embedding_cache
@@ -0,0 +1,57 @@
+"""
+Production server: uvicorn workers behind gunicorn.
+
+    cd api && gunicorn main:app -c gunicorn.conf.py
+
+Each worker keeps its own connections, pub/sub subscriptions, session caches
+and admission limits, so state is only shared between workers through
+Redis. With the default PUBSUB_BACKEND=inprocess this runs a single worker;
+with PUBSUB_BACKEND=redis it defaults to one worker per core.
+WEB_CONCURRENCY overrides the count, but more than one worker is refused
+unless PUBSUB_BACKEND=redis, STORAGE_BACKEND=qdrant (local storage is per
+process) and SESSION_CACHE_HEAD_CHECK is on. CHORUS_MAX_CONCURRENT_RUNS and
+CHORUS_MAX_QUEUED_RUNS then apply per worker.
+
+Set PROMETHEUS_MULTIPROC_DIR to an empty directory so /metrics reports the
+sum over all workers rather than whichever worker answered the scrape.
+"""
+import multiprocessing
+import os
+import sys
+from typing import List
+from config import get_config
+
+_settings = get_config()
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() if _settings.PUBSUB_BACKEND == "redis" else 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Chorus runs stream for minutes; let in-flight runs and the write-behind queue drain on restart
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "60"))
+keepalive = 5
+accesslog = "-"
+
+def single_worker_reasons() -> List[str]:
+    """Settings whose state lives in one process and so can't be spread over several workers."""
+    reasons = []
+    if _settings.PUBSUB_BACKEND != "redis":
+        reasons.append(f"PUBSUB_BACKEND={_settings.PUBSUB_BACKEND} only fans thread events out within one worker")
+    if _settings.STORAGE_BACKEND == "local":
+        reasons.append("STORAGE_BACKEND=local keeps each worker's data to itself")
+    if not _settings.SESSION_CACHE_HEAD_CHECK:
+        reasons.append("SESSION_CACHE_HEAD_CHECK is off, so cached histories miss other workers' writes")
+    return reasons
+
+def on_starting(server):
+    if server.cfg.workers > 1:
+        reasons = single_worker_reasons()
+        if reasons:
+            for reason in reasons:
+                server.log.error(f"Refusing to start {server.cfg.workers} workers: {reason}")
+            sys.exit(1)
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,355 @@
+"""
+Bulk ingestion of prior texts into the messages collection.
+
+Documents stream from text files (one document per file) and JSONL files (one
+document per line) through a generator pipeline: read -> chunk -> batch. Each
+batch is deduplicated, embedded and bulk-upserted, with at most
+INGEST_CONCURRENCY batches in flight. Chunk ids are uuid5s of the chunk's
+content hash, so duplicate text is stored once and re-running is idempotent.
+A checkpoint file records how far each source got; an interrupted run started
+again with the same checkpoint skips what was already stored. A run holds an
+OS lock on the checkpoint, so only one process at a time can advance it.
+
+    cd api && python ingest.py corpus/ --checkpoint corpus.checkpoint.json
+"""
+import argparse
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from pydantic import BaseModel
+from config import Config
+from backend import StorageBackend, create_backend
+from models import CorpusChunk
+from chunker import Chunker
+from utils import logger, get_embeddings
+
+CORPUS_NAMESPACE = uuid.UUID("5b0f3d64-4c1e-4f6a-9a0e-1f2d6c7b8a90")
+TEXT_SUFFIXES = (".txt", ".md")
+JSONL_SUFFIXES = (".jsonl", ".ndjson")
+TEXT_FIELDS = ("text", "content", "body")
+
+class Document(BaseModel):
+    source: str
+    index: int  # Position within the source, the unit checkpoints count in
+    doc_id: str
+    text: str
+
+class IngestStats(BaseModel):
+    documents: int = 0
+    chunks: int = 0
+    duplicates: int = 0
+    embedded: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def docs_per_second(self) -> float:
+        return self.documents / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def embeds_per_second(self) -> float:
+        return self.embedded / self.elapsed if self.elapsed else 0.0
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            **self.dict(),
+            "docs_per_second": round(self.docs_per_second, 2),
+            "embeds_per_second": round(self.embeds_per_second, 2)
+        }
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def chunk_id(digest: str) -> str:
+    return str(uuid.uuid5(CORPUS_NAMESPACE, digest))
+
+def discover(paths: Iterable[str]) -> List[str]:
+    """Ingestible files under `paths`, in a stable order so checkpoints line up across runs."""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                found.extend(os.path.join(root, name) for name in files if name.endswith(TEXT_SUFFIXES + JSONL_SUFFIXES))
+        else:
+            found.append(path)
+    return sorted(dict.fromkeys(os.path.abspath(path) for path in found))
+
+def iter_documents(sources: List[str], checkpoint: "Checkpoint") -> Iterator[Document]:
+    for source in sources:
+        done = checkpoint.position(source)
+        if source.endswith(JSONL_SUFFIXES):
+            with open(source, encoding="utf-8") as f:
+                for index, line in enumerate(f):
+                    if index < done or not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError as e:
+                        logger.error(f"Skipping malformed line {index + 1} of {source}: {e}")
+                        continue
+                    text = next((record[field] for field in TEXT_FIELDS if isinstance(record.get(field), str)), None)
+                    if text:
+                        yield Document(source=source, index=index, doc_id=str(record.get("id", f"{source}:{index}")), text=text)
+        elif done == 0:
+            with open(source, encoding="utf-8") as f:
+                yield Document(source=source, index=0, doc_id=source, text=f.read())
+
+def iter_chunks(documents: Iterator[Document], config: Config) -> Iterator[Tuple[Document, CorpusChunk]]:
+    chunker = Chunker.from_config(config)
+    created_at = datetime.now().isoformat()
+    for document in documents:
+        for index, chunk in enumerate(chunker.chunks(document.text)):
+            digest = content_hash(chunk.text)
+            yield document, CorpusChunk(
+                id=chunk_id(digest),
+                content=chunk.text,
+                content_hash=digest,
+                source=document.source,
+                doc_id=document.doc_id,
+                chunk_index=index,
+                created_at=created_at
+            )
+
+def iter_batches(chunks: Iterator[Tuple[Document, CorpusChunk]], size: int) -> Iterator[List[Tuple[Document, CorpusChunk]]]:
+    batch = []
+    for item in chunks:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class Checkpoint:
+    """
+    Per-source count of documents fully stored, persisted as JSON. Written
+    atomically, and only up to the oldest batch still in flight, so a crash
+    never records work that did not reach storage. The file also carries the
+    latest run's status and stats, so any process can report on it.
+    """
+
+    def __init__(self, path: str = ""):
+        self.path = path
+        self.sources: Dict[str, int] = {}
+        self.job: Dict[str, Any] = {}
+        self._lock_fd: Optional[int] = None
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.sources = data.get("sources", {})
+            self.job = data.get("job", {})
+
+    def lock(self) -> bool:
+        """
+        Claim the checkpoint for a run, or return False if a run in any process
+        holds it. The lock is an flock on a side file, so the OS drops it when
+        the holder exits, however it exits.
+        """
+        if not self.path or self._lock_fd is not None:
+            return True
+        fd = os.open(f"{self.path}.lock", os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def unlock(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def locked(self) -> bool:
+        """Whether a run in any process holds the checkpoint."""
+        if self._lock_fd is not None:
+            return True
+        if self.lock():
+            self.unlock()
+            return False
+        return True
+
+    def position(self, source: str) -> int:
+        return self.sources.get(source, 0)
+
+    def advance(self, source: str, done: int):
+        self.sources[source] = max(self.sources.get(source, 0), done)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"sources": self.sources, "job": self.job, "updated_at": datetime.now().isoformat()}, f)
+        os.replace(tmp, self.path)
+
+def ingest_job_id(paths: Iterable[str]) -> str:
+    """The same id for the same set of paths, so posting them again resumes that job."""
+    return hashlib.sha256("\0".join(sorted(paths)).encode("utf-8")).hexdigest()[:16]
+
+def checkpoint_path(root: str, job_id: str) -> str:
+    """Where the API keeps a job's checkpoint."""
+    return os.path.join(root, f".ingest-{job_id}.json")
+
+class Ingestor:
+    def __init__(self, config: Config, db_client: StorageBackend, checkpoint: Optional[Checkpoint] = None):
+        self.config = config
+        self.db_client = db_client
+        self.checkpoint = checkpoint or Checkpoint()
+        self.stats = IngestStats()
+        # Recently stored chunk ids, bounded; older repeats are caught by existing_ids
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._source_sizes: Dict[str, int] = {}
+        self._started = 0.0
+
+    async def run(self, paths: Iterable[str]) -> IngestStats:
+        self._started = time.perf_counter()
+        self.checkpoint.job = {"status": "running", "error": None}
+        try:
+            await self._run(paths)
+        except asyncio.CancelledError:
+            self._save(status="cancelled")
+            raise
+        except Exception as e:
+            self._save(status="failed", error=str(e))
+            raise
+        logger.info(f"Ingest finished: {self.stats.report()}")
+        return self.stats
+
+    async def _run(self, paths: Iterable[str]):
+        last_report = self._started
+        sources = discover(paths)
+        logger.info(f"Ingesting {len(sources)} sources")
+        # Batches finish out of order; the checkpoint only moves past the oldest unfinished one
+        in_flight: "deque[Tuple[asyncio.Task, Dict[str, int]]]" = deque()
+        chunks = iter_chunks(self._counted(iter_documents(sources, self.checkpoint)), self.config)
+        batches = iter_batches(chunks, self.config.INGEST_BATCH_SIZE)
+        try:
+            while True:
+                # Reading, chunking and tokenizing are blocking; run them off the event loop
+                batch = await asyncio.to_thread(next, batches, None)
+                if batch is None:
+                    break
+                while len(in_flight) >= self.config.INGEST_CONCURRENCY:
+                    await self._retire(in_flight)
+                in_flight.append((asyncio.create_task(self._store([chunk for _, chunk in batch])), self._completed(batch)))
+
+                now = time.perf_counter()
+                if now - last_report >= self.config.INGEST_REPORT_INTERVAL:
+                    self.stats.elapsed = now - self._started
+                    logger.info(f"Ingest progress: {self.stats.report()}")
+                    last_report = now
+            while in_flight:
+                await self._retire(in_flight)
+        finally:
+            for task, _ in in_flight:
+                task.cancel()
+            # Nothing may still be writing once the caller saves the checkpoint or closes storage
+            await asyncio.gather(*(task for task, _ in in_flight), return_exceptions=True)
+
+        for source, size in self._source_sizes.items():
+            self.checkpoint.advance(source, size)
+        self._save(status="finished")
+
+    def _counted(self, documents: Iterator[Document]) -> Iterator[Document]:
+        for document in documents:
+            self.stats.documents += 1
+            self._source_sizes[document.source] = document.index + 1
+            yield document
+
+    @staticmethod
+    def _completed(batch: List[Tuple[Document, CorpusChunk]]) -> Dict[str, int]:
+        """
+        Per source, how many documents are fully stored once this batch and all
+        earlier ones are. The batch's last document may continue into the next
+        batch, so it does not count yet.
+        """
+        completed: Dict[str, int] = {}
+        last = batch[-1][0]
+        for document, _ in batch:
+            completed[document.source] = document.index if document is last else document.index + 1
+        return completed
+
+    async def _retire(self, in_flight: "deque[Tuple[asyncio.Task, Dict[str, int]]]"):
+        task, completed = in_flight[0]
+        await task
+        in_flight.popleft()
+        for source, done in completed.items():
+            self.checkpoint.advance(source, done)
+        self._save()
+
+    def _save(self, **job: Any):
+        self.stats.elapsed = time.perf_counter() - self._started
+        self.checkpoint.job.update(job, stats=self.stats.report())
+        self.checkpoint.save()
+
+    async def _store(self, chunks: List[CorpusChunk]):
+        self.stats.chunks += len(chunks)
+        fresh = []
+        for chunk in chunks:
+            if chunk.id in self._seen:
+                self._seen.move_to_end(chunk.id)
+                self.stats.duplicates += 1
+                continue
+            self._seen[chunk.id] = None
+            fresh.append(chunk)
+        while len(self._seen) > self.config.INGEST_DEDUP_SIZE:
+            self._seen.popitem(last=False)
+        if not fresh:
+            return
+        stored = await self.db_client.existing_ids([chunk.id for chunk in fresh])
+        self.stats.duplicates += len(stored)
+        fresh = [chunk for chunk in fresh if chunk.id not in stored]
+
+        pending = fresh
+        for attempt in range(1, self.config.INGEST_MAX_RETRIES + 1):
+            if not pending:
+                break
+            # Ingested text is rarely looked up again; keep it out of the embedding cache
+            vectors = await get_embeddings([chunk.content for chunk in pending], use_cache=False)
+            for chunk, vector in zip(pending, vectors):
+                chunk.vector = vector or None
+            pending = [chunk for chunk in pending if not chunk.vector]
+            if pending and attempt < self.config.INGEST_MAX_RETRIES:
+                delay = self.config.PERSIST_RETRY_BACKOFF * 2 ** (attempt - 1)
+                logger.warning(f"Embedding {len(pending)} chunks failed (attempt {attempt}), retrying in {delay}s")
+                await asyncio.sleep(delay)
+        if pending:
+            # Stop here so the checkpoint stays before this batch and a rerun retries it
+            for chunk in fresh:
+                self._seen.pop(chunk.id, None)
+            raise RuntimeError(f"Failed to embed {len(pending)} chunks after {self.config.INGEST_MAX_RETRIES} attempts")
+
+        await self.db_client.bulk_upsert(fresh)
+        self.stats.embedded += len(fresh)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="files or directories of .txt/.md/.jsonl documents")
+    parser.add_argument("--checkpoint", default="", help="JSON file recording progress, for resuming")
+    args = parser.parse_args()
+
+    checkpoint = Checkpoint(args.checkpoint)
+    if not checkpoint.lock():
+        raise SystemExit(f"Another ingest run is using {args.checkpoint}")
+    config = Config()
+    db_client = create_backend(config)
+    try:
+        if config.STORAGE_BACKEND == "qdrant" and config.SCHEMA_BOOTSTRAP:
+            from schema import ensure_schema
+            await ensure_schema(db_client)
+        stats = await Ingestor(config, db_client, checkpoint).run(args.paths)
+        print(json.dumps(stats.report(), indent=2))
+    finally:
+        await db_client.close()
+        checkpoint.unlock()
+
+if __name__ == "__main__":
+    asyncio.run(main())
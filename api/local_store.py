@@ -0,0 +1,238 @@
+import bisect
+import uuid
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional, Set, Tuple
+import numpy as np
+from config import Config
+from utils import logger
+from models import User, ChatThread, Message, SearchFilter, CorpusChunk
+from backend import StorageBackend, next_sequence, running_mean
+from metrics import instrument_backend
+
+SEARCH_FIELDS = ("thread_id", "content", "created_at", "role", "token_value", "step")
+
+def _naive_utc(value: datetime) -> datetime:
+    # Stored created_at values are naive UTC timestamps
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+@instrument_backend
+class LocalVectorStore(StorageBackend):
+    """
+    In-process storage backend: message vectors live in one growable float32
+    NumPy matrix of unit-normalized rows, so cosine search is a single
+    matrix-vector product plus an argpartition top-k. Payloads, users and
+    threads are plain dicts, and each thread keeps a sorted (seq, id) index.
+    Thread and user centroids are float64 running means keyed by id.
+    Nothing is persisted and nothing is shared between processes.
+    """
+
+    def __init__(self, config: Config, initial_capacity: int = 1024):
+        self.config = config
+        self.dimension = config.EMBEDDING_DIMENSION
+        self._vectors = np.zeros((initial_capacity, self.dimension), dtype=np.float32)
+        self._row_ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._payloads: Dict[str, Dict[str, Any]] = {}
+        self._thread_index: Dict[str, List[Tuple[int, str]]] = {}
+        self._users: Dict[str, Dict[str, Any]] = {}
+        self._user_ids_by_key: Dict[str, str] = {}
+        self._threads: Dict[str, Dict[str, Any]] = {}
+        self._centroids: Dict[str, np.ndarray] = {}
+
+    def _store_vector(self, point_id: str, vector: List[float]):
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        if norm > 0:
+            array = array / norm
+        row = self._rows.get(point_id)
+        if row is None:
+            row = len(self._row_ids)
+            if row == self._vectors.shape[0]:
+                grown = np.zeros((row * 2, self.dimension), dtype=np.float32)
+                grown[:row] = self._vectors
+                self._vectors = grown
+            self._row_ids.append(point_id)
+            self._rows[point_id] = row
+        self._vectors[row] = array
+
+    def _candidate_rows(self, filters: Optional[SearchFilter]) -> np.ndarray:
+        if filters is None:
+            return np.arange(len(self._row_ids))
+        if filters.thread_ids is not None:
+            point_ids = [point_id for thread_id in filters.thread_ids for _, point_id in self._thread_index.get(thread_id, [])]
+        else:
+            point_ids = self._row_ids
+        rows = []
+        for point_id in point_ids:
+            row = self._rows.get(point_id)
+            if row is not None and self._matches(self._payloads.get(point_id, {}), filters):
+                rows.append(row)
+        return np.asarray(rows, dtype=np.int64)
+
+    def _matches(self, payload: Dict[str, Any], filters: SearchFilter) -> bool:
+        for key in ("user_id", "role", "step"):
+            value = getattr(filters, key)
+            if value is not None and payload.get(key) != value:
+                return False
+        if filters.created_after is not None or filters.created_before is not None:
+            try:
+                created_at = datetime.fromisoformat(payload.get("created_at", ""))
+            except ValueError:
+                return False
+            if filters.created_after is not None and created_at < _naive_utc(filters.created_after):
+                return False
+            if filters.created_before is not None and created_at > _naive_utc(filters.created_before):
+                return False
+        return True
+
+    async def search(self, query_embedding: List[float], with_vectors: bool = False, filters: Optional[SearchFilter] = None) -> List[Dict[str, Any]]:
+        rows = self._candidate_rows(filters)
+        if len(rows) == 0 or not query_embedding:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+        # A full scan multiplies the live slice directly instead of gathering rows
+        matrix = self._vectors[:len(self._row_ids)] if filters is None else self._vectors[rows]
+        scores = matrix @ query
+        k = min(self.config.SEARCH_LIMIT, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        search_results = []
+        for position in top:
+            row = rows[position]
+            point_id = self._row_ids[row]
+            payload = self._payloads.get(point_id, {})
+            search_result = {
+                "id": point_id,
+                **{field: payload.get(field, 0 if field == "token_value" else '') for field in SEARCH_FIELDS},
+                "similarity": float(scores[position])
+            }
+            if with_vectors:
+                search_result["vector"] = self._vectors[row].tolist()
+            search_results.append(search_result)
+        return search_results
+
+    async def upsert(self, content: str, embedding: List[float], is_human_generated: bool) -> None:
+        point_id = str(uuid.uuid4())
+        self._payloads[point_id] = {
+            "content": content,
+            "created_at": datetime.now().isoformat(),
+            "agent": "human" if is_human_generated else "ai",
+            "token_value": 0
+        }
+        self._store_vector(point_id, embedding)
+
+    async def bulk_upsert(self, chunks: List[CorpusChunk]) -> None:
+        for chunk in chunks:
+            self._payloads[chunk.id] = chunk.dict()
+            self._store_vector(chunk.id, chunk.vector)
+
+    async def existing_ids(self, ids: List[str]) -> Set[str]:
+        return {point_id for point_id in ids if point_id in self._payloads}
+
+    async def create_user(self, public_key: str) -> User:
+        user = User(
+            id=self.generate_unique_id(),
+            public_key=public_key,
+            created_at=datetime.utcnow().isoformat(),
+            chat_threads=[]
+        )
+        self._users[user.id] = user.dict(exclude={'vector'})
+        self._user_ids_by_key[public_key] = user.id
+        return user
+
+    async def get_user(self, public_key: str) -> Optional[User]:
+        user_id = self._user_ids_by_key.get(public_key)
+        if user_id is None:
+            return None
+        return User(**self._users[user_id])
+
+    async def get_chat_threads(self, user_id: str) -> List[ChatThread]:
+        user = self._users.get(user_id)
+        if user is None:
+            logger.error(f"User not found: {user_id}")
+            return []
+        return [ChatThread(**self._threads[thread_id]) for thread_id in user["chat_threads"] if thread_id in self._threads]
+
+    async def create_chat_thread(self, user_id: str, name: str) -> ChatThread:
+        user = self._users.get(user_id)
+        if user is None:
+            logger.error(f"User not found: {user_id}")
+            raise Exception(f"User not found: {user_id}")
+        thread = ChatThread(
+            id=self.generate_unique_id(),
+            user_id=user_id,
+            name=name,
+            created_at=datetime.utcnow().isoformat()
+        )
+        self._threads[thread.id] = thread.dict(exclude={'vector', 'messages'})
+        user["chat_threads"].append(thread.id)
+        return thread
+
+    async def get_chat_thread(self, thread_id: str) -> Optional[ChatThread]:
+        payload = self._threads.get(thread_id)
+        return ChatThread(**payload) if payload else None
+
+    async def update_thread_summary(self, thread_id: str, summary: str, summary_seq: int):
+        payload = self._threads.get(thread_id)
+        if payload is not None and (payload.get("summary_seq") is None or payload["summary_seq"] < summary_seq):
+            payload.update(summary=summary, summary_seq=summary_seq)
+
+    async def save_messages(self, messages: List[Message]):
+        for message in messages:
+            if message.seq is None:
+                message.seq = next_sequence()
+            index = self._thread_index.setdefault(message.thread_id, [])
+            if message.id not in self._payloads:
+                bisect.insort(index, (message.seq, message.id))
+            self._payloads[message.id] = message.dict(exclude={"vector"})
+            if message.vector:
+                self._store_vector(message.id, message.vector)
+                self._fold_centroid(self._threads.get(message.thread_id), message.vector)
+                self._fold_centroid(self._users.get(message.user_id), message.vector)
+
+    def _fold_centroid(self, payload: Optional[Dict[str, Any]], vector: List[float]):
+        if payload is None:
+            return
+        centroid, payload["centroid_count"] = running_mean(
+            self._centroids.get(payload["id"]), payload.get("centroid_count", 0), [vector]
+        )
+        self._centroids[payload["id"]] = np.asarray(centroid)
+
+    async def search_threads(self, query_embedding: List[float], limit: int, user_id: Optional[str] = None, exclude: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        excluded = set(exclude or ())
+        thread_ids = [
+            thread_id for thread_id, thread in self._threads.items()
+            if thread_id in self._centroids and thread_id not in excluded
+            and (user_id is None or thread["user_id"] == user_id)
+        ]
+        if not thread_ids or not query_embedding or limit <= 0:
+            return []
+        centroids = np.stack([self._centroids[thread_id] for thread_id in thread_ids])
+        norms = np.linalg.norm(centroids, axis=1)
+        query = np.asarray(query_embedding, dtype=np.float64)
+        scores = centroids @ query / np.where(norms > 0, norms, 1.0) / (np.linalg.norm(query) or 1.0)
+        top = np.argsort(-scores)[:limit]
+        return [{"id": thread_ids[index], "similarity": float(scores[index])} for index in top]
+
+    async def get_thread_centroid(self, thread_id: str) -> Tuple[Optional[ChatThread], Optional[List[float]]]:
+        payload = self._threads.get(thread_id)
+        if payload is None:
+            return None, None
+        centroid = self._centroids.get(thread_id)
+        return ChatThread(**payload), centroid.tolist() if centroid is not None else None
+
+    async def get_thread_head(self, thread_id: str) -> Optional[Tuple[int, str]]:
+        index = self._thread_index.get(thread_id)
+        return index[-1] if index else None
+
+    async def get_messages_for_thread(self, thread_id: str, before: Optional[int] = None, limit: Optional[int] = None, before_id: Optional[str] = None) -> List[Message]:
+        index = self._thread_index.get(thread_id, [])
+        end = len(index) if before is None else bisect.bisect_left(index, (before, before_id or ""))
+        start = 0 if limit is None else max(0, end - limit)
+        return [Message(**self._payloads[message_id]) for _, message_id in index[start:end]]
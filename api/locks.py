@@ -0,0 +1,77 @@
+import asyncio
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import AsyncIterator, Dict, Iterable
+from config import Config
+
+class KeyedLock:
+    """
+    Mutual exclusion per key within one process, for read-modify-writes of a
+    stored record. Several keys are always taken in sorted order, so two
+    holders of overlapping key sets cannot deadlock.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._holders: Dict[str, int] = {}
+
+    @asynccontextmanager
+    async def hold(self, keys: Iterable[str]) -> AsyncIterator[None]:
+        async with AsyncExitStack() as stack:
+            for key in sorted(set(keys)):
+                await stack.enter_async_context(self._hold_one(key))
+            yield
+
+    @asynccontextmanager
+    async def _hold_one(self, key: str) -> AsyncIterator[None]:
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._holders[key] = self._holders.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            # Drop the lock once nobody holds or waits for it, so keys don't pile up
+            self._holders[key] -= 1
+            if not self._holders[key]:
+                del self._holders[key]
+                del self._locks[key]
+
+    async def close(self):
+        pass
+
+class RedisKeyedLock(KeyedLock):
+    """
+    Per-key locks held in Redis, so every worker and node serializes on the
+    same key. A lock expires after LOCK_TIMEOUT seconds in case its holder
+    dies; waiting longer than LOCK_WAIT_TIMEOUT raises LockError.
+    """
+
+    def __init__(self, config: Config, client=None):
+        super().__init__(config)
+        if client is None:
+            try:
+                from redis import asyncio as redis_asyncio
+            except ImportError:
+                raise RuntimeError("PUBSUB_BACKEND=redis requires the redis package: pip install redis")
+            client = redis_asyncio.from_url(config.REDIS_URL)
+        self.client = client
+
+    @asynccontextmanager
+    async def _hold_one(self, key: str) -> AsyncIterator[None]:
+        async with self.client.lock(
+            f"lock:{key}",
+            timeout=self.config.LOCK_TIMEOUT,
+            blocking_timeout=self.config.LOCK_WAIT_TIMEOUT
+        ):
+            yield
+
+    async def close(self):
+        await self.client.aclose()
+
+def create_keyed_lock(config: Config) -> KeyedLock:
+    """Cross-process locks whenever workers share state through Redis, local ones otherwise."""
+    if config.PUBSUB_BACKEND == "inprocess":
+        return KeyedLock(config)
+    if config.PUBSUB_BACKEND == "redis":
+        return RedisKeyedLock(config)
+    raise ValueError(f"Unknown PUBSUB_BACKEND: {config.PUBSUB_BACKEND}")
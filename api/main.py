@@ -1,9 +1,20 @@
-from fastapi import FastAPI, WebSocket, HTTPException
+import asyncio
+import os
+import re
+from contextlib import suppress
+from typing import Dict, List
+from fastapi import FastAPI, WebSocket, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.websockets import WebSocketDisconnect
 from chorus import Chorus
-from config import Config
-from database import DatabaseClient
+from config import get_config
+from backend import create_backend
+from persistence import MessageWriter
+from connection import Connection
+from pubsub import create_pubsub
+from wire import negotiate
+from schema import ensure_schema
+from metrics import configure_tracing, monitor_event_loop, render_metrics, shutdown_tracing
+from ingest import Checkpoint, Ingestor, checkpoint_path, ingest_job_id
 from utils import logger
 from pydantic import BaseModel
 from models import User, ChatThread
@@ -22,9 +33,98 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-config = Config()
-db_client = DatabaseClient(config)
-chorus = Chorus(config, db_client)
+config = get_config()
+db_client = create_backend(config)
+message_writer = MessageWriter(config, db_client)
+pubsub = create_pubsub(config)
+chorus = Chorus(config, db_client, message_writer, pubsub=pubsub)
+loop_monitor = None
+# Ingest runs started by this worker; their status lives in the checkpoint file for every worker to read
+ingest_jobs: Dict[str, asyncio.Task] = {}
+
+@app.on_event("startup")
+async def startup():
+    global loop_monitor
+    configure_tracing(config)
+    if config.METRICS_LOOP_LAG_INTERVAL > 0:
+        loop_monitor = asyncio.create_task(monitor_event_loop(config.METRICS_LOOP_LAG_INTERVAL))
+    if config.STORAGE_BACKEND == "qdrant" and config.SCHEMA_BOOTSTRAP:
+        await ensure_schema(db_client)
+    message_writer.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Stop ingest runs first; they still write to the database and checkpoint as they unwind
+    tasks = list(ingest_jobs.values())
+    for task in tasks:
+        task.cancel()
+    for task in tasks:
+        with suppress(asyncio.CancelledError, Exception):
+            await task
+    await message_writer.stop()
+    await pubsub.close()
+    await db_client.close()
+    if loop_monitor is not None:
+        loop_monitor.cancel()
+        with suppress(asyncio.CancelledError):
+            await loop_monitor
+    shutdown_tracing()
+
+@app.get("/metrics")
+async def metrics():
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
+class IngestRequest(BaseModel):
+    paths: List[str]  # Files or directories, relative to INGEST_ROOT
+
+def ingest_job_status(job_id: str, checkpoint: Checkpoint) -> dict:
+    status = {"job_id": job_id, "status": None, "error": None, "stats": None, **checkpoint.job}
+    if status["status"] == "running" and not checkpoint.locked():
+        # The worker running it died or was restarted; posting the paths again resumes it
+        status["status"] = "interrupted"
+    return status
+
+def finish_ingest(job_id: str, checkpoint: Checkpoint):
+    ingest_jobs.pop(job_id, None)
+    checkpoint.unlock()
+    status = ingest_job_status(job_id, checkpoint)
+    if status["status"] == "failed":
+        logger.error(f"Ingest job {job_id} failed: {status['error']}")
+    else:
+        logger.info(f"Ingest job {job_id} {status['status']}: {status['stats']}")
+
+@app.post("/ingest")
+async def start_ingest(request: IngestRequest):
+    """Start a bulk ingestion job in the background; poll GET /ingest/{job_id} for progress."""
+    if not config.INGEST_ROOT:
+        raise HTTPException(status_code=404, detail="Ingestion is disabled; set INGEST_ROOT")
+    root = os.path.realpath(config.INGEST_ROOT)
+    paths = [os.path.realpath(os.path.join(root, path)) for path in request.paths]
+    if not paths or any(os.path.commonpath([root, path]) != root or not os.path.exists(path) for path in paths):
+        raise HTTPException(status_code=400, detail="Paths must exist inside INGEST_ROOT")
+    job_id = ingest_job_id(paths)
+    checkpoint = Checkpoint(checkpoint_path(root, job_id))
+    # The lock spans workers, so the same paths are never ingested twice at once
+    if not checkpoint.lock():
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is already ingesting these paths")
+
+    ingestor = Ingestor(config, db_client, checkpoint)
+    checkpoint.job = {"status": "running", "error": None, "stats": ingestor.stats.report()}
+    checkpoint.save()
+    task = asyncio.create_task(ingestor.run(paths))
+    task.add_done_callback(lambda _: finish_ingest(job_id, checkpoint))
+    ingest_jobs[job_id] = task
+    return ingest_job_status(job_id, checkpoint)
+
+@app.get("/ingest/{job_id}")
+async def get_ingest(job_id: str):
+    if not config.INGEST_ROOT:
+        raise HTTPException(status_code=404, detail="Ingestion is disabled; set INGEST_ROOT")
+    path = checkpoint_path(os.path.realpath(config.INGEST_ROOT), job_id)
+    if not re.fullmatch(r"[0-9a-f]{16}", job_id) or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Unknown ingest job")
+    return ingest_job_status(job_id, Checkpoint(path))
 
 class ConnectRequest(BaseModel):
     public_key: str
@@ -36,49 +136,6 @@ class MessageRequest(BaseModel):
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     logger.info("WebSocket connection accepted")
-    await websocket.accept()
-    try:
-        while True:
-            data = await websocket.receive_json()
-            logger.info(f"Received data: {data}")
-            if 'public_key' in data:
-                public_key = data['public_key']
-                user = await db_client.get_user(public_key)
-                if not user:
-                    user = await db_client.create_user(public_key)
-                chat_threads = await db_client.get_chat_threads(user.id)
-                logger.info(f"Sending init message with chat_threads: {[thread.dict() for thread in chat_threads]}")
-                await websocket.send_json({
-                    "type": "init",
-                    "user": user.dict(),
-                    "chat_threads": [thread.dict() for thread in chat_threads]
-                })
-            elif 'type' in data and data['type'] == 'get_thread_messages':
-                thread_id = data['thread_id']
-                logger.info(f"Received 'get_thread_messages' request for thread {thread_id}")
-                messages = await db_client.get_messages_for_thread(thread_id)
-                logger.info(f"Retrieved {len(messages)} messages for thread {thread_id}")
-                await websocket.send_json({
-                    'type': 'thread_messages',
-                    'thread_id': thread_id,
-                    'messages': [msg.dict() for msg in messages]  # Ensure 'step' is included
-                })
-            elif 'prompt' in data:
-                user_prompt = data['prompt']
-                thread_id = data['thread_id']
-                chat_history = await db_client.get_messages_for_thread(thread_id)
-                await chorus.run(user_prompt, websocket, chat_history, thread_id)
-            elif data.get('type') == 'create_thread':
-                user_id = data['user_id']
-                name = data['name']
-                logger.info(f"Received request to create new thread for user {user_id} with name {name}")
-                thread = await db_client.create_chat_thread(user_id, name)
-                await websocket.send_json({
-                    'type': 'new_thread',
-                    'chat_thread': thread.dict()
-                })
-    except WebSocketDisconnect:
-        logger.info("WebSocket disconnected")
-    except Exception as e:
-        logger.error(f"Error: {str(e)}")
-        await websocket.send_json({"type": "error", "error": str(e)})
+    subprotocol = negotiate(websocket)
+    await websocket.accept(subprotocol=subprotocol)
+    await Connection(websocket, config, db_client, chorus, pubsub, subprotocol).serve()
@@ -0,0 +1,179 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from config import Config
+
+# Not utils.logger: utils records its model calls here
+logger = logging.getLogger(__name__)
+
+# Seconds buckets from cache hits up to multi-minute Chorus turns
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+CHORUS_STEP_SECONDS = Histogram("chorus_step_seconds", "Wall-clock time of each Chorus step", ["step"], buckets=LATENCY_BUCKETS)
+CHORUS_RUNS_IN_FLIGHT = Gauge("chorus_runs_in_flight", "Chorus runs currently executing", multiprocess_mode="livesum")
+CHORUS_RUNS_QUEUED = Gauge("chorus_runs_queued", "Chorus runs waiting for a run slot", multiprocess_mode="livesum")
+CHORUS_RUNS_REJECTED = Counter("chorus_runs_rejected_total", "Chorus runs turned away because the queue was full")
+LLM_REQUEST_SECONDS = Histogram("llm_request_seconds", "Upstream model call latency", ["kind", "model"], buckets=LATENCY_BUCKETS)
+LLM_FIRST_TOKEN_SECONDS = Histogram("llm_first_token_seconds", "Time to the first streamed completion token", ["model"], buckets=LATENCY_BUCKETS)
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens sent to and received from models", ["kind", "model", "direction"])
+LLM_ERRORS = Counter("llm_errors_total", "Failed upstream model calls", ["kind", "model"])
+COMPLETION_CACHE_LOOKUPS = Counter("completion_cache_lookups_total", "Completion cache outcomes", ["outcome"])
+DB_OPERATION_SECONDS = Histogram("db_operation_seconds", "Storage backend call latency", ["backend", "operation"], buckets=LATENCY_BUCKETS)
+DB_OPERATION_ERRORS = Counter("db_operation_errors_total", "Storage backend calls that raised", ["backend", "operation"])
+WS_FRAME_BYTES = Histogram("ws_frame_bytes", "Websocket frame sizes", ["direction"], buckets=SIZE_BUCKETS)
+WS_CONNECTIONS = Gauge("ws_connections", "Open websocket connections", multiprocess_mode="livesum")
+WS_REQUESTS_IN_FLIGHT = Gauge("ws_requests_in_flight", "Websocket requests being handled", multiprocess_mode="livesum")
+PERSIST_QUEUE_DEPTH = Gauge("persist_queue_depth", "Messages waiting in the write-behind queue", multiprocess_mode="livesum")
+EVENT_LOOP_LAG_SECONDS = Histogram("event_loop_lag_seconds", "How late the event loop runs a scheduled wake-up", buckets=LATENCY_BUCKETS)
+
+def render_metrics() -> Tuple[bytes, str]:
+    """The Prometheus exposition, aggregated over all workers when PROMETHEUS_MULTIPROC_DIR is set."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+async def monitor_event_loop(interval: float):
+    """Record event-loop lag until cancelled."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - start - interval))
+
+class TraceExporter:
+    """
+    Appends finished spans to a JSONL file, one object per line. Spans are
+    buffered and written off the event loop in batches.
+    """
+
+    def __init__(self, path: str, batch_size: int = 256):
+        self.path = path
+        self.batch_size = batch_size
+        self._buffer: List[Dict[str, Any]] = []
+        self._file_lock = threading.Lock()
+
+    def export(self, span: Dict[str, Any]):
+        self._buffer.append(span)
+        if len(self._buffer) >= self.batch_size:
+            batch, self._buffer = self._buffer, []
+            try:
+                asyncio.get_running_loop().run_in_executor(None, self._write, batch)
+            except RuntimeError:
+                self._write(batch)
+
+    def flush(self):
+        batch, self._buffer = self._buffer, []
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch: List[Dict[str, Any]]):
+        try:
+            with self._file_lock, open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(span, default=str) + "\n" for span in batch)
+        except OSError as e:
+            logger.error(f"Error writing trace spans to {self.path}: {e}")
+
+_exporter: Optional[TraceExporter] = None
+_current_span: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("current_span", default=None)
+
+def configure_tracing(config: Config):
+    global _exporter
+    if _exporter is not None:
+        _exporter.flush()
+    _exporter = TraceExporter(config.TRACE_EXPORT_PATH) if config.TRACE_EXPORT_PATH else None
+
+def shutdown_tracing():
+    if _exporter is not None:
+        _exporter.flush()
+
+@asynccontextmanager
+async def span(name: str, **attributes):
+    """
+    A timed span nested under the current one, exported when tracing is on.
+    Yields the attribute dict so callers can add results such as token counts.
+    """
+    if _exporter is None:
+        yield attributes
+        return
+    parent = _current_span.get()
+    record = {
+        "trace_id": parent["trace_id"] if parent else uuid.uuid4().hex,
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": parent["span_id"] if parent else None,
+        "name": name,
+        "start": time.time(),
+        "attributes": attributes,
+    }
+    token = _current_span.set(record)
+    started = time.perf_counter()
+    try:
+        yield attributes
+    except BaseException as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        record["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        _exporter.export(record)
+
+def record_span(name: str, started: float, duration: float, **attributes):
+    """
+    Export an already finished span under the current one. For code such as
+    async generators that cannot hold a span open across yields.
+    """
+    if _exporter is None:
+        return
+    parent = _current_span.get()
+    _exporter.export({
+        "trace_id": parent["trace_id"] if parent else uuid.uuid4().hex,
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": parent["span_id"] if parent else None,
+        "name": name,
+        "start": started,
+        "duration_ms": round(duration * 1000, 3),
+        "attributes": attributes,
+    })
+
+def record_llm_call(kind: str, model: str, seconds: float, prompt_tokens: int, completion_tokens: int):
+    LLM_REQUEST_SECONDS.labels(kind, model).observe(seconds)
+    if prompt_tokens:
+        LLM_TOKENS.labels(kind, model, "prompt").inc(prompt_tokens)
+    if completion_tokens:
+        LLM_TOKENS.labels(kind, model, "completion").inc(completion_tokens)
+
+def instrument_backend(cls):
+    """
+    Class decorator timing every public async method of a storage backend
+    (including inherited ones) as db_operation_seconds and a db.<name> span.
+    """
+    backend = cls.__name__
+    for name, method in inspect.getmembers(cls, inspect.iscoroutinefunction):
+        if name.startswith("_"):
+            continue
+
+        @functools.wraps(method)
+        async def timed(self, *args, _method=method, _name=name, **kwargs):
+            started = time.perf_counter()
+            try:
+                async with span(f"db.{_name}", backend=backend):
+                    return await _method(self, *args, **kwargs)
+            except Exception:
+                DB_OPERATION_ERRORS.labels(backend, _name).inc()
+                raise
+            finally:
+                DB_OPERATION_SECONDS.labels(backend, _name).observe(time.perf_counter() - started)
+        setattr(cls, name, timed)
+    return cls
@@ -0,0 +1,246 @@
+import asyncio
+from datetime import datetime, timezone
+from typing import List
+import numpy as np
+from qdrant_client import models
+from config import Config
+from database import DatabaseClient, centroid_operations
+from schema import ensure_schema, staging_name, vectors_config
+from utils import logger
+
+def _created_at_us(created_at: str) -> int:
+    try:
+        parsed = datetime.fromisoformat(created_at)
+    except (TypeError, ValueError):
+        return 0
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1_000_000)
+
+async def migrate_thread_messages(db_client: DatabaseClient):
+    """
+    Move thread membership from the chat_threads `messages` ID list onto the
+    messages themselves: every listed message gets its thread_id and a seq that
+    follows the list order, then the list is removed from the thread.
+    """
+    config = db_client.config
+    client = db_client.client
+    await ensure_schema(db_client, allow_legacy_vectors=True)
+
+    migrated_threads = 0
+    offset = None
+    while True:
+        threads, offset = await client.scroll(
+            collection_name=config.CHAT_THREADS_COLLECTION,
+            limit=100,
+            offset=offset,
+            with_payload=["messages"],
+            with_vectors=False
+        )
+        for thread in threads:
+            message_ids: List[str] = thread.payload.get("messages") or []
+            if message_ids:
+                records = await client.retrieve(
+                    collection_name=config.MESSAGES_COLLECTION,
+                    ids=message_ids,
+                    with_payload=["created_at"],
+                    with_vectors=False
+                )
+                created_at = {str(record.id): record.payload.get("created_at", "") for record in records}
+
+                operations = []
+                seq = 0
+                for message_id in message_ids:
+                    if message_id not in created_at:
+                        logger.warning(f"Message {message_id} listed on thread {thread.id} not found; skipping")
+                        continue
+                    # Keep the list order even when timestamps tie or go backwards
+                    seq = max(_created_at_us(created_at[message_id]), seq + 1)
+                    operations.append(models.SetPayloadOperation(
+                        set_payload=models.SetPayload(
+                            payload={"thread_id": str(thread.id), "seq": seq},
+                            points=[message_id]
+                        )
+                    ))
+                if operations:
+                    await client.batch_update_points(
+                        collection_name=config.MESSAGES_COLLECTION,
+                        update_operations=operations
+                    )
+
+            await client.delete_payload(
+                collection_name=config.CHAT_THREADS_COLLECTION,
+                keys=["messages"],
+                points=[thread.id]
+            )
+            migrated_threads += 1
+
+        if offset is None:
+            break
+
+    logger.info(f"Migrated message membership for {migrated_threads} threads")
+
+async def backfill_message_users(db_client: DatabaseClient):
+    """
+    Give every message without a user_id its thread's user_id, so "user"
+    scoped searches and user centroids also cover messages stored before
+    messages carried their owner.
+    """
+    config = db_client.config
+    client = db_client.client
+    backfilled_threads = 0
+    offset = None
+    while True:
+        threads, offset = await client.scroll(
+            collection_name=config.CHAT_THREADS_COLLECTION,
+            limit=100,
+            offset=offset,
+            with_payload=["user_id"],
+            with_vectors=False
+        )
+        operations = [
+            models.SetPayloadOperation(
+                set_payload=models.SetPayload(
+                    payload={"user_id": thread.payload["user_id"]},
+                    filter=models.Filter(
+                        must=[
+                            models.FieldCondition(key="thread_id", match=models.MatchValue(value=str(thread.id))),
+                            models.IsEmptyCondition(is_empty=models.PayloadField(key="user_id"))
+                        ]
+                    )
+                )
+            )
+            for thread in threads if thread.payload.get("user_id")
+        ]
+        if operations:
+            await client.batch_update_points(
+                collection_name=config.MESSAGES_COLLECTION,
+                update_operations=operations
+            )
+            backfilled_threads += len(operations)
+        if offset is None:
+            break
+
+    logger.info(f"Backfilled message user_id for {backfilled_threads} threads")
+
+async def _copy_payloads(db_client: DatabaseClient, source: str, target: str) -> int:
+    copied = 0
+    offset = None
+    while True:
+        points, offset = await db_client.client.scroll(
+            collection_name=source,
+            limit=256,
+            offset=offset,
+            with_payload=True,
+            with_vectors=False
+        )
+        if points:
+            await db_client.client.upsert(
+                collection_name=target,
+                points=[models.PointStruct(id=point.id, vector={}, payload=point.payload) for point in points]
+            )
+            copied += len(points)
+        if offset is None:
+            return copied
+
+async def strip_placeholder_vectors(db_client: DatabaseClient):
+    """
+    Rebuild the users and chat_threads collections without the [0.0] * 1536
+    vectors that were stored on every point. The payloads are staged in a
+    temporary collection, the original is recreated with the vectorless layout
+    from schema.vectors_config, and the payloads are copied back.
+
+    Safe to rerun after a crash: while the original still has its old layout
+    the staged copy is redone from it, and once the original is gone or
+    recreated the copy-back resumes from the staging collection, which is only
+    dropped after every point is back.
+    """
+    config = db_client.config
+    client = db_client.client
+    for collection_name in (config.USERS_COLLECTION, config.CHAT_THREADS_COLLECTION):
+        staging = staging_name(collection_name)
+        layout = vectors_config(config, collection_name)
+        source_exists = await client.collection_exists(collection_name)
+        legacy = source_exists and isinstance((await client.get_collection(collection_name)).config.params.vectors, models.VectorParams)
+
+        if legacy:
+            # The original still holds every point, so any staged copy is stale
+            if await client.collection_exists(staging):
+                await client.delete_collection(staging)
+            await client.create_collection(collection_name=staging, vectors_config=layout)
+            staged = await _copy_payloads(db_client, collection_name, staging)
+            await client.delete_collection(collection_name)
+        elif await client.collection_exists(staging):
+            logger.warning(f"Resuming interrupted migration of {collection_name} from {staging}")
+            staged = (await client.count(collection_name=staging, exact=True)).count
+        else:
+            logger.info(f"Collection {collection_name} is already vectorless")
+            continue
+
+        if not await client.collection_exists(collection_name):
+            await client.create_collection(collection_name=collection_name, vectors_config=layout)
+        restored = await _copy_payloads(db_client, staging, collection_name)
+        if restored != staged:
+            raise Exception(f"Copied {staged} points out of {collection_name} but {restored} back; keeping {staging}")
+        await client.delete_collection(staging)
+        logger.info(f"Stripped placeholder vectors from {restored} points in {collection_name}")
+
+    # Recreated collections need their payload indexes again
+    await ensure_schema(db_client)
+
+async def backfill_centroids(db_client: DatabaseClient):
+    """
+    Recompute every thread and user centroid from the stored message vectors.
+    Run once after upgrading; afterwards save_messages keeps them current.
+    """
+    config = db_client.config
+    client = db_client.client
+    sums = {config.CHAT_THREADS_COLLECTION: {}, config.USERS_COLLECTION: {}}
+    offset = None
+    while True:
+        points, offset = await client.scroll(
+            collection_name=config.MESSAGES_COLLECTION,
+            limit=256,
+            offset=offset,
+            with_payload=["thread_id", "user_id"],
+            with_vectors=True
+        )
+        for point in points:
+            if not point.vector:
+                continue
+            vector = np.asarray(point.vector, dtype=np.float64)
+            vector /= np.linalg.norm(vector) or 1.0
+            for collection_name, key in ((config.CHAT_THREADS_COLLECTION, "thread_id"), (config.USERS_COLLECTION, "user_id")):
+                owner = point.payload.get(key)
+                if owner:
+                    total, count = sums[collection_name].get(owner, (0.0, 0))
+                    sums[collection_name][owner] = (total + vector, count + 1)
+        if offset is None:
+            break
+
+    for collection_name, owners in sums.items():
+        existing = set()
+        owner_ids = list(owners)
+        for start in range(0, len(owner_ids), 256):
+            records = await client.retrieve(collection_name=collection_name, ids=owner_ids[start:start + 256], with_payload=False, with_vectors=False)
+            existing.update(str(record.id) for record in records)
+        operations = []
+        for owner in existing:
+            total, count = owners[owner]
+            operations.extend(centroid_operations(owner, (total / count).tolist(), count))
+        for start in range(0, len(operations), 256):
+            await client.batch_update_points(collection_name=collection_name, update_operations=operations[start:start + 256])
+        logger.info(f"Backfilled {len(existing)} centroids in {collection_name}")
+
+async def main():
+    db_client = DatabaseClient(Config())
+    try:
+        await migrate_thread_messages(db_client)
+        await backfill_message_users(db_client)
+        await strip_placeholder_vectors(db_client)
+        await backfill_centroids(db_client)
+    finally:
+        await db_client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,7 +2,6 @@ from typing import List, Dict, Any, Optional
 from enum import Enum
 from pydantic import BaseModel, Field, field_validator
 from datetime import datetime
-import json
 
 class ChorusStepEnum(str, Enum):
     ACTION = "action"
@@ -16,7 +15,8 @@ class User(BaseModel):
     id: str
     public_key: str
     created_at: str
-    vector: Optional[List[float]] = Field(default_factory=list)
+    vector: Optional[List[float]] = Field(default=None, exclude=True)  # Running mean of the user's message embeddings; never serialized
+    centroid_count: int = 0  # Messages folded into vector
     chat_threads: List[str] = Field(default_factory=list)
 
 class ChatThread(BaseModel):
@@ -24,22 +24,43 @@ class ChatThread(BaseModel):
     user_id: str
     name: str
     created_at: str
-    messages: List[str] = Field(default_factory=list)
-    vector: Optional[List[float]] = Field(default=None)
+    messages: List[str] = Field(default_factory=list)  # Legacy; membership now lives on Message.thread_id/seq
+    summary: Optional[str] = None  # Rolling summary of messages up to summary_seq
+    summary_seq: Optional[int] = None
+    vector: Optional[List[float]] = Field(default=None, exclude=True)  # Running mean of the thread's message embeddings; never serialized
+    centroid_count: int = 0  # Messages folded into vector
 
 class Message(BaseModel):
     id: str                   # Changed from message_id to id
     thread_id: str
+    user_id: Optional[str] = None
     role: str                 # 'user', 'assistant', or 'system'
     content: str
     created_at: str
     step: Optional[str] = None
+    seq: Optional[int] = None  # Ordering key within the thread
     token_value: Optional[float] = None
-    vector: Optional[List[float]] = None  # Include if you're storing vectors
+    vector: Optional[List[float]] = Field(default=None, exclude=True)  # Stored as the point vector; never serialized
+
+class CorpusChunk(BaseModel):
+    """A chunk of a bulk-ingested document, stored as its own point alongside messages."""
+    id: str                   # uuid5 of content_hash, so re-ingesting the same text overwrites it
+    content: str
+    content_hash: str
+    source: str
+    doc_id: str
+    chunk_index: int
+    created_at: str
+    agent: str = "human"
+    token_value: float = 0
+    vector: Optional[List[float]] = Field(default=None, exclude=True)
 
 class ChorusState:
     def __init__(self):
-        self.messages: List[Message] = []
+        self.messages: List[Dict[str, str]] = []
+        self.thread_id: Optional[str] = None
+        self.user_id: Optional[str] = None
+        self.user_prompt: str = ""
         self.current_step: ChorusStepEnum = ChorusStepEnum.ACTION
         self.is_complete: bool = False
         self.is_interrupted: bool = False
@@ -59,6 +80,15 @@ class ChorusState:
     def loop(self):
         self.current_step = ChorusStepEnum.ACTION
 
+class SearchFilter(BaseModel):
+    """Restricts a vector search; every field left as None is unconstrained."""
+    thread_ids: Optional[List[str]] = None
+    user_id: Optional[str] = None
+    role: Optional[str] = None
+    step: Optional[str] = None
+    created_after: Optional[datetime] = None
+    created_before: Optional[datetime] = None
+
 class Source(BaseModel):
     id: str
     thread_id: Optional[str] = None  # Make thread_id optional
@@ -86,4 +116,13 @@ class ChorusResponse(BaseModel):
     }
 
     def to_json(self):
-        return json.dumps(self.dict(), default=str)
+        return self.model_dump_json()
+
+class ChorusDelta(BaseModel):
+    """A partial frame carrying the next tokens of a step that is still generating."""
+    type: str = "chorus_delta"
+    step: str
+    content: str
+
+    def to_json(self):
+        return self.model_dump_json()
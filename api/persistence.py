@@ -0,0 +1,93 @@
+import asyncio
+from contextlib import suppress
+from typing import List, Optional
+from config import Config
+from backend import StorageBackend
+from models import Message
+from metrics import PERSIST_QUEUE_DEPTH
+from utils import logger, get_embeddings
+
+class MessageWriter:
+    """
+    Write-behind persistence stage for Chorus messages.
+
+    Messages are enqueued without waiting on storage. A background worker drains
+    the queue in batches of up to PERSIST_BATCH_SIZE (or whatever arrives within
+    PERSIST_FLUSH_INTERVAL), embeds the ones without a vector in a single batched
+    call and saves them with one bulk upsert. The queue is bounded, so producers
+    wait once PERSIST_QUEUE_SIZE messages are pending.
+    """
+
+    def __init__(self, config: Config, db_client: StorageBackend):
+        self.config = config
+        self.db_client = db_client
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=config.PERSIST_QUEUE_SIZE)
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def enqueue(self, message: Message):
+        await self.queue.put(message)
+        PERSIST_QUEUE_DEPTH.set(self.queue.qsize())
+
+    async def stop(self):
+        """Flush everything still queued, then stop the worker."""
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=self.config.PERSIST_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"Timed out flushing message queue; {self.queue.qsize()} messages not persisted")
+        self._worker.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._worker
+        self._worker = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.config.PERSIST_FLUSH_INTERVAL
+            while len(batch) < self.config.PERSIST_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout=timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._persist(batch)
+            except Exception as e:
+                logger.error(f"Unexpected error persisting message batch: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+                PERSIST_QUEUE_DEPTH.set(self.queue.qsize())
+
+    async def _persist(self, batch: List[Message]):
+        for attempt in range(1, self.config.PERSIST_MAX_RETRIES + 1):
+            try:
+                unembedded = [message for message in batch if not message.vector]
+                if unembedded:
+                    vectors = await get_embeddings([message.content for message in unembedded])
+                    for message, vector in zip(unembedded, vectors):
+                        message.vector = vector or None
+
+                ready = [message for message in batch if message.vector]
+                if len(ready) < len(batch):
+                    if attempt < self.config.PERSIST_MAX_RETRIES:
+                        raise Exception("Failed to generate embeddings for queued messages")
+                    logger.error(f"Dropping {len(batch) - len(ready)} messages without embeddings")
+
+                await self.db_client.save_messages(ready)
+                return
+            except Exception as e:
+                if attempt == self.config.PERSIST_MAX_RETRIES:
+                    logger.error(f"Dropping {len(batch)} messages after {attempt} attempts: {e}")
+                    return
+                delay = self.config.PERSIST_RETRY_BACKOFF * 2 ** (attempt - 1)
+                logger.warning(f"Persisting message batch failed (attempt {attempt}), retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
@@ -0,0 +1,163 @@
+import asyncio
+from abc import ABC, abstractmethod
+from contextlib import suppress
+from typing import Any, Dict, Optional, Set
+from config import Config
+from wire import dumps, loads
+from utils import logger
+
+def thread_channel(thread_id: str) -> str:
+    return f"thread:{thread_id}"
+
+class Subscription:
+    """
+    Events published to one channel, in order. The buffer holds
+    PUBSUB_QUEUE_SIZE events; a subscriber that falls further behind loses the
+    oldest ones rather than stalling publishers.
+    """
+
+    def __init__(self, pubsub: "PubSub", channel: str, maxsize: int):
+        self.pubsub = pubsub
+        self.channel = channel
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+
+    def deliver(self, event: Dict[str, Any]):
+        if self.queue.full():
+            self.queue.get_nowait()
+            logger.warning(f"Subscriber on {self.channel} is falling behind; dropped an event")
+        self.queue.put_nowait(event)
+
+    async def get(self) -> Dict[str, Any]:
+        return await self.queue.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Dict[str, Any]:
+        return await self.get()
+
+    async def close(self):
+        await self.pubsub.unsubscribe(self)
+
+class PubSub(ABC):
+    """
+    Fan-out of thread events (new messages, Chorus step results) to every
+    socket watching the thread, whichever worker or node it is connected to.
+    Subscriptions are local; backends only differ in how published events
+    reach the other processes.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self._subscriptions: Dict[str, Set[Subscription]] = {}
+
+    async def subscribe(self, channel: str) -> Subscription:
+        subscription = Subscription(self, channel, self.config.PUBSUB_QUEUE_SIZE)
+        subscribers = self._subscriptions.setdefault(channel, set())
+        subscribers.add(subscription)
+        if len(subscribers) == 1:
+            await self._listen(channel)
+        return subscription
+
+    async def unsubscribe(self, subscription: Subscription):
+        subscribers = self._subscriptions.get(subscription.channel)
+        if not subscribers or subscription not in subscribers:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self._subscriptions[subscription.channel]
+            await self._unlisten(subscription.channel)
+
+    def _deliver(self, channel: str, event: Dict[str, Any]):
+        for subscription in list(self._subscriptions.get(channel, ())):
+            subscription.deliver(event)
+
+    @abstractmethod
+    async def publish(self, channel: str, event: Dict[str, Any]):
+        ...
+
+    async def _listen(self, channel: str):
+        pass
+
+    async def _unlisten(self, channel: str):
+        pass
+
+    async def close(self):
+        self._subscriptions.clear()
+
+class InProcessPubSub(PubSub):
+    """Fan-out within one process; enough for a single worker."""
+
+    async def publish(self, channel: str, event: Dict[str, Any]):
+        self._deliver(channel, event)
+
+class RedisPubSub(PubSub):
+    """
+    Fan-out through Redis PUBLISH/SUBSCRIBE, so sockets on every worker and
+    node see each other's thread events. Each process keeps one Redis
+    subscription per watched channel and one listener task, and fans events
+    out to its local subscribers. Any client with the redis.asyncio interface
+    can be injected, e.g. fakeredis for tests.
+    """
+
+    def __init__(self, config: Config, client=None):
+        super().__init__(config)
+        if client is None:
+            try:
+                from redis import asyncio as redis_asyncio
+            except ImportError:
+                raise RuntimeError("PUBSUB_BACKEND=redis requires the redis package: pip install redis")
+            client = redis_asyncio.from_url(config.REDIS_URL)
+        self.client = client
+        self._pubsub = client.pubsub()
+        self._listener: Optional[asyncio.Task] = None
+
+    async def publish(self, channel: str, event: Dict[str, Any]):
+        await self.client.publish(channel, dumps(event))
+
+    async def _listen(self, channel: str):
+        await self._pubsub.subscribe(channel)
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._run_listener())
+
+    async def _unlisten(self, channel: str):
+        await self._pubsub.unsubscribe(channel)
+
+    async def _run_listener(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error reading from Redis pub/sub: {e}")
+                await asyncio.sleep(1.0)
+                continue
+            if not message or message.get("type") != "message":
+                continue
+            channel = message["channel"]
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            try:
+                event = loads(message["data"])
+            except (TypeError, ValueError) as e:
+                logger.error(f"Dropping malformed pub/sub event on {channel}: {e}")
+                continue
+            self._deliver(channel, event)
+
+    async def close(self):
+        await super().close()
+        if self._listener is not None:
+            self._listener.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._listener
+            self._listener = None
+        await self._pubsub.aclose()
+        await self.client.aclose()
+
+def create_pubsub(config: Config) -> PubSub:
+    if config.PUBSUB_BACKEND == "inprocess":
+        return InProcessPubSub(config)
+    if config.PUBSUB_BACKEND == "redis":
+        return RedisPubSub(config)
+    raise ValueError(f"Unknown PUBSUB_BACKEND: {config.PUBSUB_BACKEND}")
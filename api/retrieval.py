@@ -0,0 +1,105 @@
+import hashlib
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Optional
+import numpy as np
+from config import Config
+from context import count_tokens
+from embedding_cache import normalize_text
+from models import SearchFilter
+
+class RetrievalPipeline:
+    """
+    Turns raw vector-search hits into the context block for the Experience step:
+
+    1. collapse exact duplicates by normalized-content hash, keeping the best hit;
+    2. drop hits scoring below RETRIEVAL_MIN_SCORE;
+    3. pick hits greedily by maximal marginal relevance over their vectors,
+       skipping any hit whose cosine similarity to an already picked one is at
+       least RETRIEVAL_DUPLICATE_THRESHOLD, until RETRIEVAL_TOP_K hits or
+       RETRIEVAL_TOKEN_BUDGET tokens of content are reached.
+
+    Hits without vectors are ranked by score alone.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+
+    def scope_filter(self, thread_id: Optional[str], user_id: Optional[str]) -> Optional[SearchFilter]:
+        """
+        The search restriction for the Experience step under CHORUS_SEARCH_SCOPE:
+        "global" searches every message, "user" only the user's own messages and
+        "thread" only the current thread. CHORUS_SEARCH_RECENCY_DAYS bounds by age
+        and CHORUS_SEARCH_ROLE / CHORUS_SEARCH_STEP by message kind. Narrower
+        scopes trade recall for cheaper, faster queries.
+        """
+        filters = SearchFilter()
+        scope = self.config.CHORUS_SEARCH_SCOPE
+        if scope == "user" and user_id:
+            filters.user_id = user_id
+        elif scope == "thread" and thread_id:
+            filters.thread_ids = [thread_id]
+        if self.config.CHORUS_SEARCH_RECENCY_DAYS > 0:
+            filters.created_after = datetime.utcnow() - timedelta(days=self.config.CHORUS_SEARCH_RECENCY_DAYS)
+        filters.role = self.config.CHORUS_SEARCH_ROLE or None
+        filters.step = self.config.CHORUS_SEARCH_STEP or None
+        if filters == SearchFilter():
+            return None
+        return filters
+
+    def select(self, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        candidates = [
+            result for result in self._collapse_exact(results)
+            if result.get('similarity', 0.0) >= self.config.RETRIEVAL_MIN_SCORE
+        ]
+        if not candidates:
+            return []
+        candidates.sort(key=lambda result: result.get('similarity', 0.0), reverse=True)
+
+        if all(result.get('vector') for result in candidates):
+            order = self._mmr_order(candidates)
+        else:
+            order = range(len(candidates))
+
+        selected = []
+        used_tokens = 0
+        for index in order:
+            result = candidates[index]
+            tokens = count_tokens(result['content'])
+            if used_tokens + tokens > self.config.RETRIEVAL_TOKEN_BUDGET:
+                continue
+            selected.append(result)
+            used_tokens += tokens
+            if len(selected) >= self.config.RETRIEVAL_TOP_K:
+                break
+        return selected
+
+    def _collapse_exact(self, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        best: Dict[str, Dict[str, Any]] = {}
+        for result in results:
+            key = hashlib.sha1(normalize_text(result.get('content', '')).encode("utf-8")).hexdigest()
+            current = best.get(key)
+            if current is None or result.get('similarity', 0.0) > current.get('similarity', 0.0):
+                best[key] = result
+        return list(best.values())
+
+    def _mmr_order(self, candidates: List[Dict[str, Any]]) -> List[int]:
+        vectors = np.asarray([result['vector'] for result in candidates], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms > 0, norms, 1.0)
+        relevance = np.asarray([result.get('similarity', 0.0) for result in candidates], dtype=np.float32)
+
+        mmr_lambda = self.config.RETRIEVAL_MMR_LAMBDA
+        max_similarity = np.full(len(candidates), -1.0, dtype=np.float32)
+        available = np.ones(len(candidates), dtype=bool)
+        order: List[int] = []
+        # The token budget may skip some picks, so rank a few more than top-k
+        limit = min(len(candidates), self.config.RETRIEVAL_TOP_K * 2)
+        while len(order) < limit and available.any():
+            penalty = np.where(max_similarity > -1.0, max_similarity, 0.0)
+            scores = np.where(available, mmr_lambda * relevance - (1 - mmr_lambda) * penalty, -np.inf)
+            index = int(np.argmax(scores))
+            order.append(index)
+            available[index] = False
+            max_similarity = np.maximum(max_similarity, vectors @ vectors[index])
+            available &= max_similarity < self.config.RETRIEVAL_DUPLICATE_THRESHOLD
+        return order
@@ -0,0 +1,77 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager, suppress
+from typing import Any, Awaitable, Dict
+from pydantic import BaseModel
+from config import Config
+from metrics import CHORUS_STEP_SECONDS, span
+
+class SchedulePolicy(BaseModel):
+    """
+    Which Chorus work may overlap.
+
+    prefetch_experience: the Experience vector search depends only on the user
+        prompt, so it starts alongside Action instead of after it.
+    speculative_yield: Yield starts alongside Update and is kept only if Update
+        answers RETURN; a LOOP discards it.
+    """
+    prefetch_experience: bool = True
+    speculative_yield: bool = True
+    step_delay: float = 0.0
+    max_loops: int = 1
+
+    @classmethod
+    def from_config(cls, config: Config) -> "SchedulePolicy":
+        return cls(
+            prefetch_experience=config.CHORUS_PREFETCH_EXPERIENCE,
+            speculative_yield=config.CHORUS_SPECULATIVE_YIELD,
+            step_delay=config.CHORUS_STEP_DELAY,
+            max_loops=config.CHORUS_MAX_LOOPS,
+        )
+
+class StepScheduler:
+    """Background work started ahead of the step that needs it, plus per-step wall-clock timings for one run."""
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.timings: Dict[str, float] = {}
+
+    def start(self, name: str, awaitable: Awaitable[Any]):
+        self.discard(name)
+        self._tasks[name] = asyncio.ensure_future(awaitable)
+
+    def has(self, name: str) -> bool:
+        return name in self._tasks
+
+    async def result(self, name: str) -> Any:
+        """Wait for a started task; its result stays available for later steps."""
+        return await asyncio.shield(self._tasks[name])
+
+    async def take(self, name: str) -> Any:
+        """Wait for a started task and forget it."""
+        return await self._tasks.pop(name)
+
+    def discard(self, name: str):
+        task = self._tasks.pop(name, None)
+        if task is not None and not task.done():
+            task.cancel()
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with suppress(asyncio.CancelledError, Exception):
+                await task
+
+    @asynccontextmanager
+    async def timed(self, name: str):
+        start = time.perf_counter()
+        try:
+            async with span(f"chorus.{name}"):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+            CHORUS_STEP_SECONDS.labels(name).observe(elapsed)
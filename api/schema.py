@@ -0,0 +1,168 @@
+import asyncio
+from typing import Dict, Optional
+from qdrant_client import models
+from config import Config
+from database import DatabaseClient, CENTROID_VECTOR
+from utils import logger
+
+class SchemaError(Exception):
+    pass
+
+def collection_specs(config: Config) -> Dict[str, Dict[str, models.PayloadSchemaType]]:
+    """Payload indexes every collection must carry, keyed by collection name."""
+    return {
+        config.MESSAGES_COLLECTION: {
+            "thread_id": models.PayloadSchemaType.KEYWORD,
+            "user_id": models.PayloadSchemaType.KEYWORD,
+            "role": models.PayloadSchemaType.KEYWORD,
+            "step": models.PayloadSchemaType.KEYWORD,
+            "created_at": models.PayloadSchemaType.DATETIME,
+            "seq": models.PayloadSchemaType.INTEGER,
+        },
+        config.CHAT_THREADS_COLLECTION: {
+            "user_id": models.PayloadSchemaType.KEYWORD,
+            "created_at": models.PayloadSchemaType.DATETIME,
+        },
+        config.USERS_COLLECTION: {
+            "public_key": models.PayloadSchemaType.KEYWORD,
+            "created_at": models.PayloadSchemaType.DATETIME,
+        },
+    }
+
+def messages_quantization(config: Config) -> Optional[models.QuantizationConfig]:
+    """Quantization for the messages collection under MESSAGES_QUANTIZATION."""
+    if config.MESSAGES_QUANTIZATION == "scalar":
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8,
+                quantile=0.99,
+                always_ram=True
+            )
+        )
+    if config.MESSAGES_QUANTIZATION == "binary":
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+    if config.MESSAGES_QUANTIZATION == "none":
+        return None
+    raise SchemaError(f"Unknown MESSAGES_QUANTIZATION: {config.MESSAGES_QUANTIZATION}")
+
+async def ensure_messages_storage(db_client: DatabaseClient):
+    """
+    Bring the messages collection's quantization and on-disk originals in line
+    with Config. Qdrant rebuilds the quantized index in the background.
+    """
+    config = db_client.config
+    client = db_client.client
+    quantization = messages_quantization(config)
+    info = await client.get_collection(config.MESSAGES_COLLECTION)
+    current = info.config.quantization_config
+    vectors = info.config.params.vectors
+
+    if type(current) is not type(quantization):
+        logger.info(f"Setting {config.MESSAGES_COLLECTION} quantization to {config.MESSAGES_QUANTIZATION}")
+        await client.update_collection(
+            collection_name=config.MESSAGES_COLLECTION,
+            quantization_config=quantization or models.Disabled.DISABLED
+        )
+    if isinstance(vectors, models.VectorParams) and bool(vectors.on_disk) != config.MESSAGES_VECTORS_ON_DISK:
+        logger.info(f"Setting {config.MESSAGES_COLLECTION} vectors on_disk={config.MESSAGES_VECTORS_ON_DISK}")
+        await client.update_collection(
+            collection_name=config.MESSAGES_COLLECTION,
+            vectors_config={"": models.VectorParamsDiff(on_disk=config.MESSAGES_VECTORS_ON_DISK)}
+        )
+
+def vectors_config(config: Config, collection_name: str):
+    """
+    Messages carry one unnamed embedding. Users and chat threads only have an
+    optional named centroid vector, so their points can be stored payload-only.
+    """
+    if collection_name == config.MESSAGES_COLLECTION:
+        return models.VectorParams(
+            size=config.EMBEDDING_DIMENSION,
+            distance=models.Distance.COSINE,
+            on_disk=config.MESSAGES_VECTORS_ON_DISK
+        )
+    return {CENTROID_VECTOR: models.VectorParams(size=config.EMBEDDING_DIMENSION, distance=models.Distance.COSINE)}
+
+def staging_name(collection_name: str) -> str:
+    """Where migrations park a collection's points while it is recreated."""
+    return f"{collection_name}_migrating"
+
+def verify_vectors(collection_name: str, actual, expected, allow_legacy_vectors: bool = False):
+    if isinstance(expected, dict) and isinstance(actual, models.VectorParams):
+        if allow_legacy_vectors:
+            return
+        raise SchemaError(
+            f"Collection {collection_name} still stores placeholder vectors for every point; "
+            f"run `python migrations.py` to make its points vectorless"
+        )
+    if isinstance(expected, dict):
+        pairs = [(actual.get(name) if isinstance(actual, dict) else None, params) for name, params in expected.items()]
+    else:
+        pairs = [(actual, expected)]
+    for current, params in pairs:
+        if current is None or current.size != params.size or current.distance != params.distance:
+            raise SchemaError(
+                f"Collection {collection_name} has vectors {actual}, expected {expected}"
+            )
+
+async def ensure_schema(db_client: DatabaseClient, allow_legacy_vectors: bool = False):
+    """
+    Create any missing collection and payload index, and verify that existing
+    collections use the configured vector layout, size and distance. Safe to run on
+    every startup: existing indexes are left alone. Collections still in the
+    pre-migration layout, or left mid-migration, are refused unless
+    `allow_legacy_vectors` is set (by the migrations themselves).
+    """
+    config = db_client.config
+    client = db_client.client
+    existing = {collection.name for collection in (await client.get_collections()).collections}
+
+    for collection_name, indexes in collection_specs(config).items():
+        if staging_name(collection_name) in existing and not allow_legacy_vectors:
+            raise SchemaError(
+                f"Migration of {collection_name} was interrupted; run `python migrations.py` to finish it"
+            )
+        expected_vectors = vectors_config(config, collection_name)
+        if collection_name not in existing:
+            logger.info(f"Creating collection {collection_name}")
+            try:
+                await client.create_collection(
+                    collection_name=collection_name,
+                    vectors_config=expected_vectors,
+                    quantization_config=messages_quantization(config) if collection_name == config.MESSAGES_COLLECTION else None
+                )
+            except Exception:
+                # Another worker bootstrapping at the same time may have created it first
+                if not await client.collection_exists(collection_name):
+                    raise
+            payload_schema = (await client.get_collection(collection_name)).payload_schema or {}
+        else:
+            info = await client.get_collection(collection_name)
+            verify_vectors(collection_name, info.config.params.vectors, expected_vectors, allow_legacy_vectors)
+            payload_schema = info.payload_schema or {}
+
+        for field_name, field_schema in indexes.items():
+            current = payload_schema.get(field_name)
+            if current is None:
+                logger.info(f"Creating {field_schema.value} payload index on {collection_name}.{field_name}")
+                await client.create_payload_index(
+                    collection_name=collection_name,
+                    field_name=field_name,
+                    field_schema=field_schema
+                )
+            elif current.data_type != field_schema:
+                logger.warning(
+                    f"Payload index {collection_name}.{field_name} is {current.data_type}, expected {field_schema.value}"
+                )
+
+    await ensure_messages_storage(db_client)
+
+async def main():
+    db_client = DatabaseClient(Config())
+    try:
+        await ensure_schema(db_client)
+    finally:
+        await db_client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+from config import Config
+from backend import StorageBackend
+from models import Message
+from utils import logger
+
+class HistoryRegistry:
+    """
+    In-process fan-out of committed messages to every live SessionCache, so a
+    connection's cached thread stays current when another connection in the
+    same worker writes to that thread.
+    """
+
+    def __init__(self):
+        self._sessions: "weakref.WeakSet[SessionCache]" = weakref.WeakSet()
+
+    def register(self, session: "SessionCache"):
+        self._sessions.add(session)
+
+    def unregister(self, session: "SessionCache"):
+        self._sessions.discard(session)
+
+    def publish(self, message: Message, origin: Optional["SessionCache"] = None):
+        for session in list(self._sessions):
+            if session is not origin:
+                session.apply(message)
+
+history_registry = HistoryRegistry()
+
+class SessionCache:
+    """
+    Per-connection cache of the newest CONTEXT_HISTORY_LIMIT messages of each
+    recently used thread, so follow-up prompts start Chorus without re-reading
+    history. Writes from this process arrive through `record` and the
+    HistoryRegistry. Writes from other workers are caught by a head check
+    before each use (SESSION_CACHE_HEAD_CHECK): one limit-1 read of the
+    (seq, id) of the thread's newest stored message, which must already be in
+    the cache. Messages still in the write-behind queue are newer than the
+    stored head, so they never invalidate the entry.
+    """
+
+    def __init__(self, config: Config, db_client: StorageBackend, registry: HistoryRegistry = history_registry):
+        self.config = config
+        self.db_client = db_client
+        self.registry = registry
+        self._threads: "OrderedDict[str, List[Message]]" = OrderedDict()
+        self._keys: Dict[str, Set[Tuple[Optional[int], str]]] = {}  # (seq, id) of each cached message
+        registry.register(self)
+
+    def close(self):
+        self.registry.unregister(self)
+        self._threads.clear()
+        self._keys.clear()
+
+    def prime(self, thread_id: str, messages: List[Message]):
+        """Cache `messages` as the thread's newest history (oldest first)."""
+        tail = [message.model_copy(update={"vector": None}) for message in messages[-self.config.CONTEXT_HISTORY_LIMIT:]]
+        self._threads[thread_id] = tail
+        self._keys[thread_id] = {(message.seq, message.id) for message in tail}
+        self._threads.move_to_end(thread_id)
+        while len(self._threads) > self.config.SESSION_CACHE_THREADS:
+            evicted, _ = self._threads.popitem(last=False)
+            self._keys.pop(evicted, None)
+
+    def invalidate(self, thread_id: str):
+        self._threads.pop(thread_id, None)
+        self._keys.pop(thread_id, None)
+
+    def record(self, message: Message):
+        """A message committed on this connection; share it with the rest of the process."""
+        self.apply(message)
+        self.registry.publish(message, origin=self)
+
+    def apply(self, message: Message):
+        cached = self._threads.get(message.thread_id)
+        key = (message.seq, message.id)
+        if cached is None or key in self._keys[message.thread_id]:
+            return
+        if cached and message.seq is not None and cached[-1].seq is not None and key < (cached[-1].seq, cached[-1].id):
+            # Out of order; cheaper to refetch than to splice
+            self.invalidate(message.thread_id)
+            return
+        cached.append(message.model_copy(update={"vector": None}))
+        self._keys[message.thread_id].add(key)
+        if len(cached) > self.config.CONTEXT_HISTORY_LIMIT:
+            dropped = cached.pop(0)
+            self._keys[message.thread_id].discard((dropped.seq, dropped.id))
+
+    async def history(self, thread_id: str) -> List[Message]:
+        """The thread's newest CONTEXT_HISTORY_LIMIT messages, from cache when still valid."""
+        cached = self._threads.get(thread_id)
+        if cached is not None and await self._is_current(thread_id):
+            self._threads.move_to_end(thread_id)
+            return list(cached)
+        messages = await self.db_client.get_messages_for_thread(thread_id, limit=self.config.CONTEXT_HISTORY_LIMIT)
+        self.prime(thread_id, messages)
+        return messages
+
+    async def _is_current(self, thread_id: str) -> bool:
+        if not self.config.SESSION_CACHE_HEAD_CHECK:
+            return True
+        head = await self.db_client.get_thread_head(thread_id)
+        if head is None or head in self._keys.get(thread_id, ()):
+            return True
+        logger.info(f"Session cache for thread {thread_id} is stale; refetching history")
+        self.invalidate(thread_id)
+        return False
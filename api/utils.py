@@ -1,62 +1,211 @@
+import asyncio
 import logging
-from litellm import completion, embedding
-from typing import List, Dict, Any
-from config import Config
+import time
+import numpy as np
+from litellm import acompletion, aembedding
+from typing import List, Dict, Any, AsyncIterator, Optional
+from config import Config, get_config
+from embedding_cache import get_embedding_cache, cache_key
+from chunker import Chunker
+from metrics import LLM_ERRORS, LLM_FIRST_TOKEN_SECONDS, record_llm_call, record_span, span
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-async def get_embedding(input_text: str, model: str) -> List[float]:
-    try:
-        # Chunk the input text
-        chunks = chunk_text(input_text, chunk_size=4000, overlap=200)
-
-        # Get embeddings for each chunk
-        chunk_embeddings = []
-        for chunk in chunks:
-            response = embedding(
-                model=f"azure/{model}",
-                input=chunk,
-                api_key=Config().AZURE_API_KEY,
-                api_base=Config().AZURE_API_BASE,
-                api_version=Config().AZURE_API_VERSION
-            )
-            chunk_embeddings.append(response['data'][0]['embedding'])
+_embedding_semaphore: Optional[asyncio.Semaphore] = None
+_embedding_chunker: Optional[Chunker] = None
+
+def _usage(response: Any) -> Dict[str, int]:
+    usage = getattr(response, "usage", None)
+    if usage is None and isinstance(response, dict):
+        usage = response.get("usage")
+    if usage is None:
+        return {}
+    if not isinstance(usage, dict):
+        usage = {key: getattr(usage, key, None) for key in ("prompt_tokens", "completion_tokens")}
+    return {key: value for key, value in usage.items() if isinstance(value, int)}
+
+def _estimate_tokens(texts: List[str]) -> int:
+    # context imports this module, so it can only be imported once both are loaded
+    from context import count_tokens
+    return sum(count_tokens(text) for text in texts)
+
+def _get_embedding_chunker(config: Config) -> Chunker:
+    # Texts are embedded whole up to the model's input limit and mean-pooled beyond it
+    global _embedding_chunker
+    if _embedding_chunker is None:
+        _embedding_chunker = Chunker.from_config(config, config.EMBEDDING_MAX_TOKENS)
+    return _embedding_chunker
+
+def _get_embedding_semaphore(config: Config) -> asyncio.Semaphore:
+    global _embedding_semaphore
+    if _embedding_semaphore is None:
+        _embedding_semaphore = asyncio.Semaphore(config.EMBEDDING_CONCURRENCY)
+    return _embedding_semaphore
+
+async def _embed_batch(batch: List[str], model: str, config: Config) -> List[List[float]]:
+    async with _get_embedding_semaphore(config):
+        started = time.perf_counter()
+        try:
+            async with span("llm.embedding", model=model, inputs=len(batch)) as attributes:
+                response = await aembedding(
+                    model=f"azure/{model}",
+                    input=batch,
+                    api_key=config.AZURE_API_KEY,
+                    api_base=config.AZURE_API_BASE,
+                    api_version=config.AZURE_API_VERSION
+                )
+                attributes["prompt_tokens"] = _usage(response).get("prompt_tokens") or _estimate_tokens(batch)
+        except Exception:
+            LLM_ERRORS.labels("embedding", model).inc()
+            raise
+        record_llm_call("embedding", model, time.perf_counter() - started, attributes["prompt_tokens"], 0)
+    data = sorted(response['data'], key=lambda item: item['index'])
+    return [item['embedding'] for item in data]
 
-        # Average the embeddings if there are multiple chunks
-        if len(chunk_embeddings) > 1:
-            averaged_embedding = [sum(x) / len(chunk_embeddings) for x in zip(*chunk_embeddings)]
-            return averaged_embedding
+async def get_embeddings(texts: List[str], model: Optional[str] = None, use_cache: bool = True) -> List[List[float]]:
+    """
+    Embed many texts at once. Texts already in the embedding cache are served from
+    it; the rest are split into chunks of at most EMBEDDING_MAX_TOKENS tokens, sent
+    in batches of up to EMBEDDING_BATCH_SIZE chunks and EMBEDDING_BATCH_TOKENS tokens
+    with at most EMBEDDING_CONCURRENCY requests in flight, and their chunk vectors
+    mean-pooled.
+    A text that yields no chunks, or a failed request, produces an empty vector.
+    Bulk loads pass use_cache=False so they do not evict the live working set.
+    """
+    config = get_config()
+    model = model or config.EMBEDDING_MODEL
+    async with span("embedding.get", model=model, texts=len(texts)) as attributes:
+        if use_cache:
+            vectors = await _get_embeddings(texts, model, config)
         else:
-            return chunk_embeddings[0]
+            vectors = await _compute_embeddings(texts, model, config)
+        attributes["empty"] = sum(1 for vector in vectors if not vector)
+        return vectors
+
+async def _get_embeddings(texts: List[str], model: str, config: Config) -> List[List[float]]:
+    cache = get_embedding_cache(config)
+    keys = [cache_key(model, text) for text in texts]
+    vectors = await cache.get_many(list(dict.fromkeys(keys)))
+
+    # Embed each distinct uncached text once, sharing texts another caller is already embedding
+    pending: Dict[str, str] = {}
+    for key, text in zip(keys, texts):
+        if key not in vectors and key not in pending:
+            pending[key] = text
+    while pending:
+        owned, waiting = cache.claim(pending)
+        try:
+            if owned:
+                computed = await _compute_embeddings([pending[key] for key in owned], model, config)
+                fresh = dict(zip(owned, computed))
+                await cache.put_many(fresh)
+                vectors.update(fresh)
+        except BaseException:
+            cache.release(owned)
+            raise
+        cache.release(owned, vectors)
+        for key, future in waiting.items():
+            try:
+                vectors[key] = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+        # Texts whose embedding caller was cancelled are claimed again
+        pending = {key: text for key, text in pending.items() if key not in vectors}
+
+    return [vectors.get(key, []) for key in keys]
+
+async def _compute_embeddings(texts: List[str], model: str, config: Config) -> List[List[float]]:
+    try:
+        chunker = _get_embedding_chunker(config)
+        batches: List[List[str]] = []
+        batch_tokens = 0
+        owners: List[int] = []
+        for index, text in enumerate(texts):
+            for chunk in chunker.chunks(text):
+                if not batches or len(batches[-1]) >= config.EMBEDDING_BATCH_SIZE or batch_tokens + chunk.tokens > config.EMBEDDING_BATCH_TOKENS:
+                    batches.append([])
+                    batch_tokens = 0
+                batches[-1].append(chunk.text)
+                batch_tokens += chunk.tokens
+                owners.append(index)
+        if not batches:
+            return [[] for _ in texts]
+
+        results = await asyncio.gather(*(_embed_batch(batch, model, config) for batch in batches))
+
+        vectors = np.asarray([vector for result in results for vector in result], dtype=np.float32)
+        owner_index = np.asarray(owners)
+        sums = np.zeros((len(texts), vectors.shape[1]), dtype=np.float32)
+        np.add.at(sums, owner_index, vectors)
+        counts = np.bincount(owner_index, minlength=len(texts))
+
+        return [
+            (sums[i] / counts[i]).tolist() if counts[i] else []
+            for i in range(len(texts))
+        ]
     except Exception as e:
-        logger.error(f"Error getting embedding: {e}")
-        return []
+        logger.error(f"Error getting embeddings: {e}")
+        return [[] for _ in texts]
+
+async def get_embedding(input_text: str, model: str) -> List[float]:
+    return (await get_embeddings([input_text], model))[0]
 
 async def chat_completion(messages: List[Dict[str, str]], model: str, max_tokens: int, temperature: float, functions: List[Dict[str, Any]] = None) -> str:
+    started = time.perf_counter()
     try:
-        response = completion(
-            model=model,
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            functions=functions
-        )
+        async with span("llm.completion", model=model, stream=False):
+            response = await acompletion(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                functions=functions
+            )
+        usage = _usage(response)
+        record_llm_call("completion", model, time.perf_counter() - started, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
         if response and response.choices:
             return response.choices[0].message.content or ""
         else:
             logger.error("No choices returned in chat completion response")
             return "error"
     except Exception as e:
+        LLM_ERRORS.labels("completion", model).inc()
         logger.error(f"Error during chat completion: {e}")
         return "error"
 
-def chunk_text(text: str, chunk_size: int, overlap: int) -> List[str]:
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = min(start + chunk_size, len(text))
-        chunks.append(text[start:end])
-        start += chunk_size - overlap
-    return chunks
+async def stream_chat_completion(messages: List[Dict[str, str]], model: str, max_tokens: int, temperature: float) -> AsyncIterator[str]:
+    """Yield content deltas from a streaming chat completion as they arrive."""
+    wall_start = time.time()
+    started = time.perf_counter()
+    usage: Dict[str, int] = {}
+    parts: List[str] = []
+    try:
+        response = await acompletion(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True
+        )
+        async for chunk in response:
+            usage = _usage(chunk) or usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if not parts:
+                    LLM_FIRST_TOKEN_SECONDS.labels(model).observe(time.perf_counter() - started)
+                parts.append(delta)
+                yield delta
+    except Exception:
+        LLM_ERRORS.labels("completion", model).inc()
+        raise
+    # Providers that do not report usage on streams get a tokenizer estimate
+    prompt_tokens = usage.get("prompt_tokens") or _estimate_tokens([message.get("content") or "" for message in messages])
+    completion_tokens = usage.get("completion_tokens") or _estimate_tokens(["".join(parts)])
+    duration = time.perf_counter() - started
+    record_llm_call("completion", model, duration, prompt_tokens, completion_tokens)
+    record_span("llm.completion", wall_start, duration, model=model, stream=True, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
@@ -0,0 +1,96 @@
+import json
+from typing import Any, Dict, Optional, Union
+from pydantic import BaseModel
+from fastapi import WebSocket
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+# Websocket subprotocols a client may offer; the first one the server supports wins.
+# Both are sent as binary frames; clients that negotiate neither get JSON text frames.
+SUBPROTOCOLS = {"choir.msgpack": MSGPACK, "choir.json": JSON}
+
+def _default(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
+
+def dumps(data: Any) -> bytes:
+    """
+    Encode a frame as UTF-8 JSON in one pass. Pydantic models anywhere in
+    `data` are dumped in place (their vectors are excluded by the models), so
+    callers pass models through instead of building .dict() copies first.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=_default, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, default=_default, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def loads(data: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def negotiate(websocket: WebSocket) -> Optional[str]:
+    """The subprotocol to accept from the client's offer, if any."""
+    for offered in websocket.scope.get("subprotocols") or ():
+        if offered in SUBPROTOCOLS and (SUBPROTOCOLS[offered] != MSGPACK or _msgpack() is not None):
+            return offered
+    return None
+
+def _msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        return None
+    return msgpack
+
+class Codec:
+    """
+    Frame encoding for one connection: JSON text frames by default, UTF-8
+    JSON in binary frames for clients that negotiated choir.json, or
+    MessagePack binary frames for choir.msgpack.
+    """
+
+    def __init__(self, subprotocol: Optional[str] = None):
+        self.encoding = SUBPROTOCOLS.get(subprotocol, JSON)
+        self.binary = subprotocol in SUBPROTOCOLS
+        self._packer = _msgpack() if self.encoding == MSGPACK else None
+
+    def encode(self, data: Any) -> Union[str, bytes]:
+        """A binary frame (bytes) for negotiated clients, otherwise a text frame (str)."""
+        if self._packer is not None:
+            return self._packer.packb(data, default=_default, use_bin_type=True)
+        payload = dumps(data)
+        # Binary frames carry the encoded bytes as they are; text frames need a str for the ASGI send
+        return payload if self.binary else payload.decode("utf-8")
+
+    def decode(self, frame: Union[str, bytes]) -> Dict[str, Any]:
+        # Clients on the msgpack subprotocol may still send JSON text frames
+        if self._packer is not None and isinstance(frame, bytes):
+            return self._packer.unpackb(frame, raw=False)
+        return loads(frame)
+
+    def encode_shared(self, event: Dict[str, Any], frame: Dict[str, Any]) -> Union[str, bytes]:
+        """
+        Encode a frame built from a pub/sub event once per encoding and reuse
+        it for every other local subscriber relaying the same event.
+        """
+        cache = event.setdefault("_frames", {})
+        kind = (self.encoding, self.binary)
+        if kind not in cache:
+            cache[kind] = self.encode(frame)
+        return cache[kind]
+
+    async def send(self, websocket: WebSocket, payload: Union[str, bytes]):
+        if isinstance(payload, bytes):
+            await websocket.send_bytes(payload)
+        else:
+            await websocket.send_text(payload)